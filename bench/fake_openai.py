@@ -0,0 +1,138 @@
+"""A local stand-in for the OpenAI API, scripted to walk the app through a full reading.
+
+Replies depend only on the conversation sent, so any number of sessions can share one server:
+after the first answer Emily asks a follow-up question, after the second she asks for cards,
+and once cards are selected she gives the final reading.
+"""
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SELECTED_CARDS_PREFIX = "The selected cards were"
+FILLER = "The cards turn slowly and their meaning settles around you."
+
+
+@dataclass
+class FakeConfig:
+    latency: float = 0.5  # seconds before the first byte of every completion
+    tokens: int = 200  # approximate completion tokens per reply
+    chunk_delay: float = 0.0  # seconds between streamed chunks
+    # share of card requests with an unparseable PULL line
+    malformed_rate: float = 0.0
+    cards: int = 3
+    moderation_latency: float = 0.1
+
+
+def _filler(tokens: int) -> str:
+    words = FILLER.split()
+    return " ".join(words[i % len(words)] for i in range(tokens))
+
+
+def scripted_reply(messages: list, config: FakeConfig) -> str:
+    last = messages[-2]  # the last message is the app's reinforcement prompt
+    body = _filler(config.tokens)
+    if last["role"] == "system" and last["content"].startswith(SELECTED_CARDS_PREFIX):
+        return f"{body}\n\nThank you for sitting with the cards today."
+    if last["role"] == "system":
+        # a summarization request
+        return body
+    answers = sum(1 for msg in messages if msg["role"] == "user")
+    if answers <= 1:
+        return f"{body}\n\nQUESTION: What feels most uncertain right now?"
+    if random.random() < config.malformed_rate:
+        return f"{body}\n\nPULL TAROT CARDS: a few"
+    return f"{body}\n\nPULL TAROT CARDS:{config.cards}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    config: FakeConfig
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.endswith("/moderations"):
+            time.sleep(self.config.moderation_latency)
+            inputs = (
+                body["input"] if isinstance(body["input"], list) else [body["input"]]
+            )
+            self._send_json(
+                {
+                    "id": "modr-fake",
+                    "model": "text-moderation-fake",
+                    "results": [
+                        {"flagged": False, "categories": {}, "category_scores": {}}
+                        for _ in inputs
+                    ],
+                }
+            )
+            return
+
+        time.sleep(self.config.latency)
+        text = scripted_reply(body["messages"], self.config)
+        if not body.get("stream"):
+            prompt_tokens = sum(len(m["content"].split()) for m in body["messages"])
+            completion_tokens = len(text.split())
+            self._send_json(
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "model": body["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": text},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                }
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        # roughly one token per word
+        for word in text.split(" "):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word + " "},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.config.chunk_delay:
+                time.sleep(self.config.chunk_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+def start_fake_openai(config: FakeConfig, port: int = 0) -> ThreadingHTTPServer:
+    """Serve the fake API from a daemon thread; `port` 0 picks a free one (see server.server_port)."""
+    handler = type("Handler", (_Handler,), {"config": config})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
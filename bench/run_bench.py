@@ -0,0 +1,288 @@
+"""Headless load and latency benchmark for streamlit_app.py.
+
+Each simulated user runs full readings against a local fake OpenAI server (see fake_openai.py): start the
+reading, answer every question, pull cards virtually and submit, until Emily gives the final reading.
+Readings are driven through Streamlit's LocalScriptRunner, the same in-process runner Streamlit's own
+tests use, so every click costs a real script rerun. Results are printed (or written) as JSON.
+
+    python bench/run_bench.py --concurrency 1,4,16 --readings 3 --latency 0.5 --output bench.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from fake_openai import FakeConfig, start_fake_openai
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+APP_SCRIPT = str(SRC_DIR / "streamlit_app.py")
+
+
+def _percentile(samples: list, q: float):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def _setup_runtime():
+    """Stand in for the Streamlit server, which LocalScriptRunner expects to exist."""
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import (
+        MemoryCacheStorageManager,
+    )
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+    config.set_option("runner.postScriptGC", False)
+    config.set_option("server.enableStaticServing", True)
+
+
+class ReadingDriver:
+    """Clicks through one reading, timing every rerun."""
+
+    def __init__(self, timeout: float, script_cache):
+        self.timeout = timeout
+        self.script_cache = script_cache
+        self.rerun_seconds = []
+        self._runner = None
+
+    def _settle(self):
+        """Wait for the reruns a run asked for (st.experimental_rerun) to finish in its runner, as they would in
+        the browser session, before the next interaction starts from its state."""
+        from streamlit.runtime.scriptrunner import ScriptRunnerEvent
+
+        stops = (
+            ScriptRunnerEvent.SCRIPT_STOPPED_FOR_RERUN,
+            ScriptRunnerEvent.SCRIPT_STOPPED_WITH_COMPILE_ERROR,
+            ScriptRunnerEvent.SCRIPT_STOPPED_WITH_SUCCESS,
+        )
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            last_stop = [e for e in list(self._runner.events) if e in stops][-1:]
+            if last_stop != [ScriptRunnerEvent.SCRIPT_STOPPED_FOR_RERUN]:
+                return
+            time.sleep(0.01)
+        raise RuntimeError("Rerun did not finish")
+
+    def _run(self, tree=None):
+        from streamlit.testing.local_script_runner import LocalScriptRunner
+
+        if self._runner:
+            self._settle()
+        previous = self._runner.session_state if self._runner else None
+        self._runner = LocalScriptRunner(APP_SCRIPT, previous)
+        # like the server, compile the script once for every session
+        self._runner._script_cache = self.script_cache
+        started = time.perf_counter()
+        tree = self._runner.run(
+            tree.get_widget_states() if tree is not None else None,
+            timeout=self.timeout,
+        )
+        self.rerun_seconds.append(time.perf_counter() - started)
+        for event in self._runner.event_data:
+            if event.get("exception"):
+                raise RuntimeError(f"App raised {event['exception']!r}")
+        return tree
+
+    def _click(self, tree, label: str):
+        [button for button in tree.get("button") if button.label == label][0].click()
+        self._run(tree)
+        # a click usually ends in st.experimental_rerun; render the page as it is once that has run
+        return self._run()
+
+    def reading(self) -> int:
+        """Run a full reading in a new session, returning the number of turns submitted."""
+        self._runner = None
+        tree = self._run()
+        tree = self._click(tree, "Yes")
+        turns = 0
+        while any(button.label == "Submit" for button in tree.get("button")):
+            empty_cards = [
+                box
+                for box in tree.get("text_input")
+                if box.label.startswith("Card ") and not box.value
+            ]
+            for _ in empty_cards:
+                tree = self._click(tree, "Pull Card")
+            for area in tree.get("text_area"):
+                # distinct answers, so moderation can't answer them all from its cache
+                area.set_value(
+                    f"I am benchmark {uuid.uuid4().hex[:8]}, wondering about my next release."
+                )
+            tree = self._click(tree, "Submit")
+            turns += 1
+            if turns > 20:
+                raise RuntimeError("Reading did not finish")
+        return turns
+
+
+def run_level(sessions: int, readings: int, timeout: float) -> dict:
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from utils.metrics import (
+        MODERATION_CACHE_HITS,
+        MODERATION_INPUTS,
+        MODERATION_REQUESTS,
+        SESSION_SAVE_SECONDS,
+    )
+
+    moderation_counters = (
+        MODERATION_REQUESTS,
+        MODERATION_INPUTS,
+        MODERATION_CACHE_HITS,
+    )
+    moderation_before = [counter.value() for counter in moderation_counters]
+    save_count, save_total = SESSION_SAVE_SECONDS.totals()
+    script_cache = ScriptCache()
+    drivers = [ReadingDriver(timeout, script_cache) for _ in range(sessions)]
+    errors = []
+    completed = [0]
+    lock = threading.Lock()
+
+    def user(driver: ReadingDriver):
+        for _ in range(readings):
+            try:
+                driver.reading()
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+                return
+            with lock:
+                completed[0] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(d,)) for d in drivers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    reruns = [seconds for driver in drivers for seconds in driver.rerun_seconds]
+    save_count_after, save_total_after = SESSION_SAVE_SECONDS.totals()
+    saves = save_count_after - save_count
+    save_seconds = save_total_after - save_total
+    requests, inputs, cache_hits = (
+        counter.value() - before
+        for counter, before in zip(moderation_counters, moderation_before)
+    )
+    return {
+        "sessions": sessions,
+        "readings_completed": completed[0],
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "reruns": len(reruns),
+        "reruns_per_second": round(len(reruns) / elapsed, 2),
+        "rerun_latency_seconds": {
+            "p50": _percentile(reruns, 0.50),
+            "p95": _percentile(reruns, 0.95),
+            "p99": _percentile(reruns, 0.99),
+            "max": max(reruns, default=None),
+        },
+        "save_session": {
+            "calls": saves,
+            "total_seconds": round(save_seconds, 4),
+            "mean_seconds": save_seconds / saves if saves else None,
+        },
+        "moderation": {
+            "requests": requests,
+            "inputs": inputs,
+            "cache_hits": cache_hits,
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--concurrency",
+        default="1,2,4,8",
+        help="comma separated numbers of simultaneous sessions to try, in order",
+    )
+    parser.add_argument("--readings", type=int, default=2, help="readings per session")
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--slo",
+        type=float,
+        default=None,
+        help="p95 rerun latency a level must stay under to count as sustained, default latency + 2s",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="seconds a single rerun may take"
+    )
+    parser.add_argument(
+        "--output", help="write the JSON results here instead of stdout"
+    )
+    args = parser.parse_args(argv)
+
+    fake = FakeConfig(
+        latency=args.latency,
+        tokens=args.tokens,
+        chunk_delay=args.chunk_delay,
+        malformed_rate=args.malformed_rate,
+    )
+    server = start_fake_openai(fake)
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("SESSION_DIR", tempfile.mkdtemp(prefix="emilytarot-bench-"))
+    # keep the app's own rate limits out of the measurement unless asked for
+    os.environ.setdefault("OPENAI_RPM", "1000000")
+    os.environ.setdefault("OPENAI_TPM", "1000000000")
+    os.environ.setdefault("MODERATION_RPM", "1000000")
+    os.environ.setdefault("OPENAI_QUEUE_LIMIT", "100000")
+
+    output_path = Path(args.output).resolve() if args.output else None
+    os.chdir(SRC_DIR)
+    sys.path.insert(0, str(SRC_DIR))
+    _setup_runtime()
+
+    slo = args.slo if args.slo is not None else args.latency + 2
+    levels = []
+    for sessions in (int(n) for n in args.concurrency.split(",")):
+        level = run_level(sessions, args.readings, args.timeout)
+        level["sustained"] = (
+            not level["errors"] and level["rerun_latency_seconds"]["p95"] <= slo
+        )
+        levels.append(level)
+        print(
+            f"{sessions} session(s): {level['reruns_per_second']} reruns/s, "
+            f"p95 {level['rerun_latency_seconds']['p95']:.3f}s, {len(level['errors'])} error(s)",
+            file=sys.stderr,
+        )
+
+    results = {
+        "config": {
+            "readings_per_session": args.readings,
+            "slo_p95_seconds": slo,
+            "fake_openai": vars(fake),
+            "stream_responses": os.environ.get("STREAM_RESPONSES", "1") == "1",
+            "session_store": os.environ.get("SESSION_STORE", "file"),
+        },
+        "levels": levels,
+        "sustained_sessions": max(
+            (level["sessions"] for level in levels if level["sustained"]), default=0
+        ),
+    }
+    output = json.dumps(results, indent=2)
+    if output_path:
+        output_path.write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+# lets the tests import `utils` the way the app does, from src/
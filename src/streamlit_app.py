@@ -1,24 +1,110 @@
-import json
+import hmac
 import os
 import random
-from dataclasses import dataclass, field
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 from uuid import uuid4
 
-import openai
 import streamlit as st
 
+from utils import startup
+from utils.commands import AiCommands, extract_commands
+from utils.completions import (
+    CompletionFailed,
+    FlaggedInputError,
+    MAX_LIVE_ATTEMPTS,
+    ResilientCompletion,
+    estimate_tokens,
+)
+from utils.context import build_prompt, prompt_fingerprint
+from utils.deck import card_id, card_name, draw, to_mask
+from utils.diagnostics import DiagnosticsLog
 from utils.helpers import date_id
+from utils.images import available_images, image_html
+from utils.jobs import GenerationJob, JobRunner
 from utils.messages import (
     REINFORCEMENT_SYSTEM_MSG,
     INITIAL_SYSTEM_MSG,
     INTROS,
     CARDS_REINFORCEMENT_SYSTEM_MSG,
+    SELECTED_CARDS_PREFIX,
+    SUMMARY_SYSTEM_MSG,
+)
+from utils.metrics import (
+    BAD_RESPONSES,
+    COMPLETION_RETRIES,
+    FIRST_TOKEN_SECONDS,
+    FLAGGED_INPUTS,
+    LLM_SECONDS,
+    MODEL_FAILOVERS,
+    MODERATION_CACHE_HITS,
+    MODERATION_INPUTS,
+    MODERATION_REQUESTS,
+    MODERATION_SECONDS,
+    MODERATION_SECONDS_SAVED,
+    SCRIPT_RUN_SECONDS,
+    SESSION_LOAD_SECONDS,
+    SESSION_SAVE_SECONDS,
+    SPECULATION_SECONDS_SAVED,
+    SPECULATIVE_TOKENS,
+    TOKENS,
+    start_metrics_server,
+)
+from utils.moderation import ModerationBatcher
+from utils.profiling import StackSampler
+from utils.rate_limit import Overloaded, get_rate_limiter
+from utils.rendered import Block, FrozenReading, RenderCache
+from utils.routing import ModelRouter, load_routes
+from utils.session_schema import persisted
+from utils.session_store import (
+    get_session_store,
+    get_session_writer,
+    start_retention_sweeper,
 )
 from utils.tarot import TAROT_DECK
 
+script_started = time.perf_counter()
+
 SESSION_DIR = os.environ["SESSION_DIR"]
+SESSION_STORE = os.environ.get("SESSION_STORE", "file")
+SESSION_DB = os.environ.get("SESSION_DB")
+SESSION_LAYOUT = os.environ.get("SESSION_LAYOUT", "flat")
+SESSION_COMPRESS = os.environ.get("SESSION_COMPRESS", "0") == "1"
+SESSION_RETENTION_DAYS = int(os.environ.get("SESSION_RETENTION_DAYS", "0"))
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "1") == "1"
+COMPLETION_TIMEOUT = float(os.environ.get("COMPLETION_TIMEOUT", "60"))
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", "16"))
+# start interpreting virtual cards as soon as the last one is pulled, before the user presses Submit
+SPECULATIVE_GENERATION = os.environ.get("SPECULATIVE_GENERATION", "0") == "1"
+OPENAI_RPM = float(os.environ.get("OPENAI_RPM", "500"))
+OPENAI_TPM = float(os.environ.get("OPENAI_TPM", "200000"))
+MODERATION_RPM = float(os.environ.get("MODERATION_RPM", "1000"))
+# moderation checks from all sessions are sent together, gathered for up to this long
+MODERATION_BATCH_WINDOW = float(os.environ.get("MODERATION_BATCH_WINDOW", "0.05"))
+MODERATION_BATCH_SIZE = int(os.environ.get("MODERATION_BATCH_SIZE", "32"))
+MODERATION_CACHE_TTL = float(os.environ.get("MODERATION_CACHE_TTL", "600"))
+OPENAI_QUEUE_LIMIT = int(os.environ.get("OPENAI_QUEUE_LIMIT", "50"))
+RATE_LIMIT_DB = os.environ.get("RATE_LIMIT_DB")
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "4000"))
+METRICS_PORT = os.environ.get("METRICS_PORT")
+# operators can profile a session's reruns by opening it with ?profile=<PROFILE_SECRET>
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET")
+DIAGNOSTICS_DIR = Path(
+    os.environ.get("DIAGNOSTICS_DIR", Path(SESSION_DIR) / "diagnostics")
+)
+RENDER_CACHE_DIR = Path(
+    os.environ.get("RENDER_CACHE_DIR", Path(SESSION_DIR) / "rendered")
+)
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "256"))
+# which models answer which turns; see model_routes.json
+MODEL_ROUTES = os.environ.get(
+    "MODEL_ROUTES", Path(__file__).parent / "model_routes.json"
+)
+# room left for the reply when estimating what a completion request will cost
+COMPLETION_TOKEN_ALLOWANCE = 600
 
 st.set_page_config(
     layout="wide",
@@ -28,29 +114,191 @@ st.set_page_config(
 
 
 IMAGE_DIR = (Path(__file__).parent / "images").relative_to(Path(__file__).parent)
+# streamlit columns stack on narrow screens
+HEADER_IMAGE_SIZES = "(max-width: 640px) 100vw, 20vw"
+FEATURE_IMAGE_SIZES = "(max-width: 640px) 100vw, 33vw"
+
+
+@st.cache_resource
+def _metrics_server():
+    if METRICS_PORT:
+        return start_metrics_server(int(METRICS_PORT))
+
+
+@st.cache_resource
+def _executor():
+    # moderation gates and background warm-up; completion requests have their own pool
+    return ThreadPoolExecutor(thread_name_prefix="openai")
+
+
+@st.cache_resource
+def _attempt_executor():
+    # every generation job may have a request and its hedge running, or waiting for admission, at once
+    return ThreadPoolExecutor(
+        GENERATION_WORKERS * MAX_LIVE_ATTEMPTS, thread_name_prefix="completion"
+    )
+
+
+@st.cache_resource
+def _warm_up():
+    # openai is imported lazily so it doesn't hold up the first render; load it in the background after that
+    _executor().submit(startup.openai_module)
+
+
+@st.cache_resource
+def _jobs():
+    return JobRunner(GENERATION_WORKERS)
+
+
+@st.cache_resource
+def _router():
+    return ModelRouter(
+        load_routes(MODEL_ROUTES),
+        on_failover=lambda turn_type, model: MODEL_FAILOVERS.inc(
+            turn=turn_type, model=model
+        ),
+    )
+
+
+@st.cache_resource
+def _completions():
+    return ResilientCompletion(
+        _completion_request,
+        _attempt_executor(),
+        attempt_timeout=COMPLETION_TIMEOUT,
+        admit=_admit_completion,
+        router=_router(),
+        on_first_token=FIRST_TOKEN_SECONDS.observe,
+    )
+
+
+def _chat_limiter():
+    return get_rate_limiter(
+        "chat",
+        (("requests", OPENAI_RPM), ("tokens", OPENAI_TPM)),
+        OPENAI_QUEUE_LIMIT,
+        RATE_LIMIT_DB,
+    )
+
+
+def _moderation_limiter():
+    return get_rate_limiter(
+        "moderation", (("requests", MODERATION_RPM),), OPENAI_QUEUE_LIMIT, RATE_LIMIT_DB
+    )
+
+
+@st.cache_resource
+def _moderator():
+    return ModerationBatcher(
+        _moderation_request,
+        window=MODERATION_BATCH_WINDOW,
+        max_batch=MODERATION_BATCH_SIZE,
+        cache_ttl=MODERATION_CACHE_TTL,
+        on_cache_hit=MODERATION_CACHE_HITS.inc,
+    )
+
+
+def _admit_completion(messages: list, on_position, cancelled) -> bool:
+    cost = estimate_tokens(messages) + COMPLETION_TOKEN_ALLOWANCE
+    return _chat_limiter().acquire(
+        {"requests": 1, "tokens": cost}, on_position, cancelled
+    )
+
+
+def _session_store():
+    return get_session_store(
+        SESSION_STORE,
+        SESSION_DIR,
+        SESSION_DB,
+        sharded=SESSION_LAYOUT == "sharded",
+        compress=SESSION_COMPRESS,
+    )
+
+
+@st.cache_resource
+def _render_cache():
+    return RenderCache(RENDER_CACHE_DIR, max_entries=RENDER_CACHE_SIZE)
 
 
-def save_session():
+@st.cache_resource
+def _session_sweeper():
+    if SESSION_RETENTION_DAYS:
+        return start_retention_sweeper(
+            _session_store(), SESSION_RETENTION_DAYS, derived=[_render_cache()]
+        )
+
+
+def _persisted_state() -> dict:
+    return persisted(st.session_state)
+
+
+@SESSION_SAVE_SECONDS.time()
+def save_session(compact=False):
     st.experimental_set_query_params(s=st.session_state.session_id)
-    path = Path(SESSION_DIR) / (st.session_state.session_id + ".json")
-    path.write_text(json.dumps(st.session_state.to_dict()))
+    get_session_writer(_session_store()).save(
+        st.session_state.session_id, _persisted_state(), compact=compact
+    )
+
+
+def _parse_turn(msg: dict):
+    if msg["role"] != "assistant":
+        return None
+    return asdict(extract_commands(msg["content"]))
 
 
 @dataclass
 class ChatSession:
     history: list = field(default_factory=list)
+    # the parsed commands of each assistant message, None for other messages
+    turns: list = field(default_factory=list)
+
+    def __post_init__(self):
+        # sessions saved before turns were stored get them parsed here, once
+        for msg in self.history[len(self.turns) :]:
+            self.turns.append(_parse_turn(msg))
+
+    def _says(self, message: dict):
+        self.history.append(message)
+        self.turns.append(_parse_turn(message))
 
     def user_says(self, message):
-        self.history.append({"role": "user", "content": message})
+        self._says({"role": "user", "content": message})
 
     def system_says(self, message):
-        self.history.append({"role": "system", "content": message})
+        self._says({"role": "system", "content": message})
 
     def assistant_says(self, message):
-        self.history.append({"role": "assistant", "content": message})
+        self._says({"role": "assistant", "content": message})
 
+    def commands(self, index: int = -1) -> AiCommands:
+        turn = self.turns[index]
+        if turn is None:
+            return AiCommands(questions_to_ask=[], draw_cards=0, cleaned_content="")
+        return AiCommands(**turn)
 
-def init_state():
+
+def _choose_images() -> dict:
+    imgs = random.sample(available_images(), k=4)
+    return {
+        "header_images": [imgs[0], imgs[1], imgs[2]],
+        "emily_image": str(IMAGE_DIR / "emily.png"),
+        "closing_image": imgs[3],
+    }
+
+
+def _pick_images():
+    st.session_state.update(_choose_images())
+
+
+def _restore_session(session_id: str, data: dict):
+    for k, v in data.items():
+        st.session_state[k] = v
+    get_session_writer(_session_store()).track(session_id, _persisted_state())
+    if "header_images" not in st.session_state:
+        _pick_images()
+
+
+def init_state(preloaded: Optional[dict] = None):
     query_session = st.experimental_get_query_params().get("s")
     if query_session:
         query_session = query_session[0]
@@ -64,15 +312,12 @@ def init_state():
     if "reading_in_progress" not in st.session_state:
         start_new_reading = True
         if query_session:
-            path = Path(SESSION_DIR) / (query_session + ".json")
-            try:
-                loaded_session_data = json.loads(path.read_text())
-            except:
-                pass
-            else:
-                for k, v in loaded_session_data.items():
-                    if not k.startswith("FormSubmitter"):
-                        st.session_state[k] = v
+            loaded_session_data = preloaded
+            if loaded_session_data is None:
+                with SESSION_LOAD_SECONDS.time():
+                    loaded_session_data = _session_store().load(query_session)
+            if loaded_session_data is not None:
+                _restore_session(query_session, loaded_session_data)
                 start_new_reading = False
 
         if start_new_reading:
@@ -82,22 +327,135 @@ def init_state():
 
             session_id = date_id()
             st.session_state.session_id = session_id
-            imgs = random.sample(
-                [str(x) for x in IMAGE_DIR.iterdir() if x.name != "emily.png"], k=4
-            )
-            st.session_state.header_images = [imgs[0], imgs[1], imgs[2]]
-            st.session_state.emily_image = str(IMAGE_DIR / "emily.png")
-            st.session_state.closing_image = imgs[3]
+            _pick_images()
 
             cs = ChatSession()
             cs.assistant_says(random.choice(INTROS))
             st.session_state.chat_history = cs.history
+            st.session_state.chat_turns = cs.turns
             st.session_state.chosen_virtual_cards = []
-            st.session_state.all_chosen_cards = []
-            st.session_state.bad_responses = []
+            st.session_state.drawn_cards = 0
+            st.session_state.discarded_responses = 0
+            st.session_state.discarded_tokens = 0
             st.session_state.total_tokens_used = 0
 
 
+def _profiling_requested() -> bool:
+    if not PROFILE_SECRET:
+        return False
+    requested = st.experimental_get_query_params().get("profile")
+    if requested:
+        return hmac.compare_digest(requested[0], PROFILE_SECRET)
+    # the query string is replaced once the session is saved, so the switch is kept in the session
+    return st.session_state.get("profiling", False)
+
+
+def _write_profile(profiler: StackSampler):
+    profiler.stop()
+    path = profiler.write(
+        DIAGNOSTICS_DIR / st.session_state.get("session_id", "no-session"),
+        f"{profiler.elapsed * 1000:.0f}ms",
+    )
+    print(f"Wrote rerun profile to {path}")
+
+
+def _image_block(image_path: str, sizes: str) -> Block:
+    html = image_html(image_path, sizes)
+    return ["image", image_path] if html is None else ["html", html]
+
+
+def _show_block(container, block: Block):
+    kind, value = block
+    if kind == "image":
+        container.image(value)
+    else:
+        container.markdown(value, unsafe_allow_html=kind == "html")
+
+
+def _show_image(container, image_path: str, sizes: str):
+    _show_block(container, _image_block(image_path, sizes))
+
+
+def _transcript(chat_session: ChatSession) -> List[Block]:
+    blocks = []
+    for msg, turn in zip(chat_session.history, chat_session.turns):
+        if msg["role"] == "assistant":
+            blocks.append(["markdown", turn["cleaned_content"]])
+        elif msg["role"] == "user":
+            blocks.append(
+                ["html", f"<div style='color: yellow;'> &gt; {msg['content']}</div>"]
+            )
+        elif msg["role"] == "system":
+            if msg["content"].startswith(SELECTED_CARDS_PREFIX):
+                blocks.append(
+                    ["html", f"<div style='color: red;'> &gt; {msg['content']}</div>"]
+                )
+    return blocks
+
+
+def _freeze_reading(
+    session_id: str, data: dict, images: dict
+) -> Optional[FrozenReading]:
+    """The rendering of a finished reading, or None if `data` isn't one."""
+    if data.get("pending_job") or data.get("flagged_input"):
+        return None
+    chat_session = ChatSession(history=data.get("chat_history", []))
+    if not data.get("started_chat") or chat_session.turns[-1] is None:
+        return None
+    ai_commands = chat_session.commands()
+    if ai_commands.draw_cards or ai_commands.questions_to_ask:
+        return None
+    return FrozenReading(
+        session_id=session_id,
+        header=[_image_block(i, HEADER_IMAGE_SIZES) for i in images["header_images"]],
+        feature=_image_block(images["emily_image"], FEATURE_IMAGE_SIZES),
+        transcript=_transcript(chat_session),
+        closing=_image_block(images["closing_image"], FEATURE_IMAGE_SIZES),
+    )
+
+
+def _shared_reading() -> Tuple[Optional[FrozenReading], Optional[dict]]:
+    """The frozen rendering of the finished reading a `?s=` link opens, unless it is this page's own live session.
+
+    Also returns the session data if it had to be loaded to find out, so init_state needn't load it again.
+    """
+    query_session = st.experimental_get_query_params().get("s")
+    if not query_session or not query_session[0]:
+        return None, None
+    session_id = query_session[0]
+    if st.session_state.get("session_id") == session_id:
+        return None, None
+    loaded = None
+
+    def freeze():
+        nonlocal loaded
+        with SESSION_LOAD_SECONDS.time():
+            loaded = _session_store().load(session_id)
+        if loaded is None:
+            return None
+        # sessions saved before their images were stored get new ones
+        return _freeze_reading(session_id, loaded, {**_choose_images(), **loaded})
+
+    return _render_cache().get(session_id, freeze), loaded
+
+
+def _show_frozen(frozen: FrozenReading):
+    # read-only: shown without touching (or saving) any session state
+    _, c1, c2, c3, _ = st.columns(5)
+    for column, block in zip((c1, c2, c3), frozen.header):
+        _show_block(column, block)
+    _, c1, _ = st.columns(3)
+    _show_block(c1, frozen.feature)
+    for block in frozen.transcript:
+        _show_block(st, block)
+    _, c1, _ = st.columns(3)
+    _show_block(c1, frozen.closing)
+    c1.subheader(f"[Link to this session](?s={frozen.session_id})")
+    if st.button("Start your own reading", use_container_width=True, type="primary"):
+        st.experimental_set_query_params(s="")
+        st.experimental_rerun()
+
+
 def initial_view():
     st.markdown(
         "<h1 style='text-align: center; color: purple;'>Shall we begin?</h1>",
@@ -116,41 +474,17 @@ def initial_view():
     st.button("Yes", use_container_width=True, on_click=_handle_click)
 
 
-@dataclass
-class AiCommands:
-    questions_to_ask: List[str]
-    draw_cards: int
-    cleaned_content: str
-
-
-def _extract_commands(content: str) -> AiCommands:
-    """Extract questions and number of cards to draw from the message; return the cleaned string without those cmds."""
-    num_cards = 0
-    questions = []
-    remove_lines = []
-    for line in content.splitlines():
-        if line.startswith("QUESTION: "):
-            questions.append(line.removeprefix("QUESTION: "))
-            remove_lines.append(line)
-        elif line.startswith("PULL TAROT CARDS"):
-            _, num_cards_str = line.split(":")
-            num_cards += int(num_cards_str)
-            remove_lines.append(line)
-
-    for line in remove_lines:
-        content = content.replace(line, "")
-    content = content.replace("\n\n\n", "\n\n")
-
-    return AiCommands(
-        questions_to_ask=questions, draw_cards=num_cards, cleaned_content=content
+def _show_footer():
+    st.caption(
+        "All art and text generated by Artificial Intelligence - for entertainment purposes only"
     )
+    st.caption("View on [Github](https://github.com/msull/emilytarot)")
 
 
 def main():
     _, c1, c2, c3, _ = st.columns(5)
-    c1.image(st.session_state.header_images[0])
-    c2.image(st.session_state.header_images[1])
-    c3.image(st.session_state.header_images[2])
+    for column, image in zip((c1, c2, c3), st.session_state.header_images):
+        _show_image(column, image, HEADER_IMAGE_SIZES)
     del c1, c2, c3
 
     if not st.session_state.started_chat:
@@ -158,32 +492,37 @@ def main():
         return
 
     _, c1, _ = st.columns(3)
-    c1.image(st.session_state.emily_image)
+    _show_image(c1, st.session_state.emily_image, FEATURE_IMAGE_SIZES)
     del c1
 
-    chat_session = ChatSession(history=st.session_state.chat_history)
+    chat_session = ChatSession(
+        history=st.session_state.chat_history,
+        turns=st.session_state.setdefault("chat_turns", []),
+    )
 
-    for msg in chat_session.history:
-        if msg["role"] == "assistant":
-            st.write(_extract_commands(msg["content"]).cleaned_content)
-        elif msg["role"] == "user":
-            st.write(
-                f"<div style='color: yellow;'> &gt; {msg['content']}</div>",
-                unsafe_allow_html=True,
-            )
-        elif msg["role"] == "system":
-            if msg["content"].startswith("The selected cards were"):
-                st.write(
-                    f"<div style='color: red;'> &gt; {msg['content']}</div>",
-                    unsafe_allow_html=True,
-                )
+    for block in _transcript(chat_session):
+        _show_block(st, block)
+
+    _count_late_responses()
+
+    if st.session_state.get("pending_job"):
+        _await_generation(chat_session)
+        return
 
-    ai_commands = _extract_commands(chat_session.history[-1]["content"])
+    ai_commands = chat_session.commands()
 
     if not (ai_commands.draw_cards or ai_commands.questions_to_ask):
         # reading is over
+        save_session(compact=True)
+        session_id = st.session_state.session_id
+        # freeze it now, with the images shown here, so its link is served from the cache
+        _render_cache().get(
+            session_id,
+            lambda: _freeze_reading(session_id, _persisted_state(), st.session_state),
+            retry=True,
+        )
         _, c1, _ = st.columns(3)
-        c1.image(st.session_state.closing_image)
+        _show_image(c1, st.session_state.closing_image, FEATURE_IMAGE_SIZES)
         link = f"[Link to this session](?s={st.session_state.session_id})"
         c1.subheader(link)
         del c1
@@ -195,6 +534,9 @@ def main():
 
     virtual_cards = st.session_state.card_draw_type == "Draw cards virtually"
 
+    if st.session_state.pop("busy_warning", False):
+        _warn_busy()
+
     with st.form("user-input-form"):
         answers = []
         cards = []
@@ -210,6 +552,8 @@ def main():
             if virtual_cards:
                 if st.form_submit_button("Switch to your own Tarot deck"):
                     st.session_state.chosen_virtual_cards = []
+                    _cancel_speculation()
+                    st.session_state.pop("deck_seed", None)
                     st.session_state.card_draw_type = (
                         "Draw cards from your own tarot deck"
                     )
@@ -232,18 +576,29 @@ def main():
                     if len(st.session_state.chosen_virtual_cards) == num_cards:
                         st.error("Already pulled requested number of cards")
                     else:
-                        chosen = (
-                            st.session_state.chosen_virtual_cards
-                            + st.session_state.all_chosen_cards
+                        # each seed gives a fixed deck order; pulling resumes where the last pull stopped
+                        if st.session_state.get("deck_seed") != shuffle_seed:
+                            st.session_state.deck_seed = shuffle_seed
+                            st.session_state.deck_position = 0
+                        card, st.session_state.deck_position = draw(
+                            shuffle_seed,
+                            st.session_state.deck_position,
+                            st.session_state.drawn_cards
+                            | to_mask(st.session_state.chosen_virtual_cards),
                         )
-                        card_puller = random.Random(shuffle_seed)
-                        while (choice := card_puller.choice(TAROT_DECK)) in chosen:
-                            pass
-                        st.session_state.chosen_virtual_cards.append(choice)
+                        st.session_state.chosen_virtual_cards.append(card)
+                        if (
+                            SPECULATIVE_GENERATION
+                            and len(st.session_state.chosen_virtual_cards) == num_cards
+                            and not ai_commands.questions_to_ask
+                        ):
+                            _start_speculation(
+                                chat_session, st.session_state.chosen_virtual_cards
+                            )
                         st.experimental_rerun()
                 for x in range(num_cards):
                     try:
-                        chosen = st.session_state.chosen_virtual_cards[x]
+                        chosen = card_name(st.session_state.chosen_virtual_cards[x])
                     except IndexError:
                         chosen = ""
                     cards.append(
@@ -259,8 +614,7 @@ def main():
                 deck = [""] + TAROT_DECK
                 for x in range(num_cards):
                     try:
-                        chosen = st.session_state.chosen_virtual_cards[x]
-                        select_index = deck.index(chosen)
+                        select_index = st.session_state.chosen_virtual_cards[x] + 1
                     except IndexError:
                         select_index = 0
                     cards.append(
@@ -283,93 +637,525 @@ def main():
             elif len(cards) != len(set(cards)):
                 st.error("Cannot choose the same card more than once")
                 can_submit = False
+            elif _chat_limiter().overloaded():
+                _warn_busy()
+                can_submit = False
 
             if can_submit:
                 # combine the user answers into a single response, and check it for restricted content
+                # while the reply is being generated; the reply is discarded if the check fails
+                moderation = None
                 if answers:
                     combined_answer = "\n\n".join(answers)
                     chat_session.user_says(combined_answer)
-                    _check_user_message(combined_answer)
+                    moderation = _executor().submit(
+                        _moderate, combined_answer, _moderator()
+                    )
                 if cards:
-                    chat_session.system_says(
-                        "The selected cards were: " + ", ".join(cards)
+                    chat_session.system_says(_cards_message(cards))
+                    st.session_state.drawn_cards |= to_mask(
+                        card_id(name) for name in cards
                     )
-                    st.session_state.all_chosen_cards.extend(cards)
                     st.session_state.chosen_virtual_cards = []
-                with st.spinner("Generating AI response"):
-                    got_valid_response = False
-                    attempts = 0
-                    max_attempts = 3
-                    while not got_valid_response:
-                        attempts += 1
-                        response = _get_ai_response(chat_session)
-                        try:
-                            _extract_commands(
-                                response["choices"][0]["message"]["content"]
-                            )
-                            break
-                        except Exception:
-                            print("Got bad response, trying again")
-                            st.session_state.bad_responses.append(response)
-                            st.session_state.total_tokens_used += response["usage"][
-                                "total_tokens"
-                            ]
-                            if attempts >= max_attempts:
-                                print("Out of attempts")
-                                st.error(
-                                    "Encountered an error generating your reading, sorry about that"
-                                )
-                                return
-
-                st.session_state.total_tokens_used += response["usage"]["total_tokens"]
-
-                chat_session.assistant_says(
-                    response["choices"][0]["message"]["content"]
-                )
-
-                save_session()
+                # the reply is generated in the background; the page waits for it on the next run, and so
+                # does a reloaded page if the connection drops in the meantime
+                _start_generation(chat_session, uuid4().hex, moderation)
                 st.experimental_rerun()
 
     if len(chat_session.history) > 1:
         save_session()
 
 
-class FlaggedInputError(RuntimeError):
-    pass
+def _warn_busy():
+    st.warning(
+        "Emily is with a great many seekers right now, please try submitting again in a minute"
+    )
+
+
+def _take_back_turn(chat_session: ChatSession):
+    """Remove the answers and cards submitted since the last reply, so the form asks for them again."""
+    while chat_session.history and chat_session.history[-1]["role"] != "assistant":
+        msg = chat_session.history.pop()
+        chat_session.turns.pop()
+        if msg["role"] == "system" and msg["content"].startswith(SELECTED_CARDS_PREFIX):
+            names = msg["content"].removeprefix(SELECTED_CARDS_PREFIX).lstrip(": ")
+            cards = [card_id(name) for name in names.split(", ")]
+            st.session_state.drawn_cards &= ~to_mask(cards)
+            st.session_state.chosen_virtual_cards = cards
+
 
+def _moderation_request(inputs: list) -> list:
+    _moderation_limiter().acquire({"requests": 1})
+    MODERATION_REQUESTS.inc()
+    MODERATION_INPUTS.inc(len(inputs))
+    response = startup.openai_module().Moderation.create(input=inputs)
+    return [result.flagged for result in response.results]
 
-def _check_user_message(msg: str):
-    response = openai.Moderation.create(msg)
-    if response.results[0].flagged:
+
+@MODERATION_SECONDS.time()
+def _check_user_message(msg: str, moderator: ModerationBatcher):
+    if moderator.flagged(msg):
         raise FlaggedInputError()
 
 
-def _get_ai_response(chat_session: ChatSession):
-    chat_history = chat_session.history[:]
-    # add the initial system message describing the AI's role
-    chat_history.insert(0, {"role": "system", "content": INITIAL_SYSTEM_MSG})
+def _moderate(msg: str, moderator: ModerationBatcher) -> float:
+    """Check the message, returning how long the check took."""
+    started = time.monotonic()
+    _check_user_message(msg, moderator)
+    return time.monotonic() - started
+
+
+def _add_tokens(response):
+    st.session_state.total_tokens_used += response["usage"]["total_tokens"]
+    TOKENS.inc(
+        response["usage"]["total_tokens"],
+        model=response.get("model") or "unknown",
+    )
+
+
+def _record_bad_responses(responses: list):
+    # the raw responses are logged by the job that received them; the session keeps their count and cost
+    BAD_RESPONSES.inc(len(responses))
+    st.session_state.discarded_responses += len(responses)
+    for response in responses:
+        st.session_state.discarded_tokens += response["usage"]["total_tokens"]
+        _add_tokens(response)
+
+
+def _count_late_responses():
+    # requests abandoned while out that were answered after all, once their job had recorded them
+    for response in _jobs().take_late_responses(st.session_state.session_id):
+        st.session_state.discarded_tokens += response["usage"]["total_tokens"]
+        _add_tokens(response)
+
+
+def _record_overlap(moderation_time: float, generation_time: float):
+    # run serially, the moderation round trip would have been added on top of the generation
+    saved = min(moderation_time, generation_time)
+    print(
+        f"Moderation took {moderation_time:.2f}s alongside generation; saved {saved:.2f}s"
+    )
+    MODERATION_SECONDS_SAVED.inc(saved)
+
 
-    # now add a reinforcing message for the AI, based on whether we are interpreting cards right now or not
-    last_msg = chat_history[-1]
+def _prompt_inputs(chat_session: ChatSession) -> dict:
+    """What the next prompt is built from; the job builds it, since summarizing older turns is a request itself."""
+    # add a reinforcing message for the AI, based on whether we are interpreting cards right now or not
+    last_msg = chat_session.history[-1]
     if last_msg["role"] == "system" and last_msg["content"].startswith(
-        "The selected cards were"
+        SELECTED_CARDS_PREFIX
     ):
-        chat_history.append(
-            {"role": "system", "content": CARDS_REINFORCEMENT_SYSTEM_MSG}
+        reinforcement_msg = CARDS_REINFORCEMENT_SYSTEM_MSG
+    else:
+        reinforcement_msg = REINFORCEMENT_SYSTEM_MSG
+    return {
+        "history": list(chat_session.history),
+        "reinforcement": reinforcement_msg,
+        "summary": st.session_state.get("history_summary"),
+    }
+
+
+def _build_prompt(inputs: dict, router: ModelRouter) -> Tuple[list, dict]:
+    """The messages for the next completion, and the summary and its token cost for the session to keep.
+
+    Runs on the job thread, so `router` is looked up by the script run that started it. If summarizing fails, the
+    older turns are sent in full this time.
+    """
+    summary_tokens = 0
+
+    def summarize(messages: list) -> str:
+        nonlocal summary_tokens
+        response = _summarize_history(messages, router)
+        summary_tokens += response["usage"]["total_tokens"]
+        return response["choices"][0]["message"]["content"]
+
+    # the initial system message describing the AI's role goes first; older turns may be summarized
+    args = (inputs["history"], INITIAL_SYSTEM_MSG, inputs["reinforcement"])
+    try:
+        messages, summary = build_prompt(
+            *args, CONTEXT_TOKEN_BUDGET, inputs["summary"], summarize
+        )
+    except Exception as e:
+        print(f"Couldn't summarize older turns ({e!r}), sending them in full")
+        messages, summary = build_prompt(
+            *args, float("inf"), inputs["summary"], summarize
+        )
+    return messages, {"history_summary": summary, "summary_tokens": summary_tokens}
+
+
+def _apply_prompt(prompt: Optional[dict]):
+    # what building the prompt on the job changed, as the job recorded it in the saved session
+    if prompt is None:
+        return
+    st.session_state.total_tokens_used += prompt["summary_tokens"]
+    if prompt["history_summary"] is None:
+        st.session_state.pop("history_summary", None)
+    else:
+        st.session_state.history_summary = prompt["history_summary"]
+
+
+def _cards_message(cards: list) -> str:
+    return f"{SELECTED_CARDS_PREFIX}: " + ", ".join(cards)
+
+
+def _spent_tokens(response: dict, discarded: list) -> int:
+    spent = sum(r["usage"]["total_tokens"] for r in discarded)
+    if response is not None:
+        spent += response["usage"]["total_tokens"]
+    return spent
+
+
+def _start_speculation(chat_session: ChatSession, card_ids: list):
+    """Start the reply to the cards just pulled before Submit is pressed; Submit uses it if the prompt matches.
+
+    Nothing is saved until then. A speculation that's never used is cancelled when the user switches decks or
+    submits something else, but what it used by then (or all of it, if the user left) still costs tokens, which
+    SPECULATIVE_TOKENS counts against the time SPECULATION_SECONDS_SAVED counts.
+    """
+    if _chat_limiter().overloaded():
+        # don't add guesses to a queue of real requests
+        return
+    preview = ChatSession(
+        history=list(chat_session.history), turns=list(chat_session.turns)
+    )
+    preview.system_says(_cards_message([card_name(c) for c in card_ids]))
+    inputs = _prompt_inputs(preview)
+    fingerprint = prompt_fingerprint([inputs])
+    completions = _completions()
+    router = _router()
+
+    def speculate(job):
+        messages, prompt = _build_prompt(inputs, router)
+        try:
+            response, discarded = completions.run(
+                messages,
+                stream=STREAM_RESPONSES,
+                on_update=job.show,
+                on_queue=job.set_queue_position,
+                turn_type=_turn_type(messages),
+                cancelled=job.cancelled,
+                on_late_response=job.add_late_response,
+            )
+        except CompletionFailed as e:
+            SPECULATIVE_TOKENS.inc(
+                _spent_tokens(None, e.discarded), outcome="generated"
+            )
+            raise
+        SPECULATIVE_TOKENS.inc(_spent_tokens(response, discarded), outcome="generated")
+        return response, discarded, prompt
+
+    # a fresh id each time: an earlier speculation for the same prompt may have been cancelled
+    job_id = f"speculative-{uuid4().hex}"
+    _jobs().submit(st.session_state.session_id, job_id, speculate)
+    st.session_state.speculation = {"job_id": job_id, "fingerprint": fingerprint}
+
+
+def _cancel_speculation():
+    speculation = st.session_state.pop("speculation", None)
+    if speculation is not None:
+        job = _jobs().get(st.session_state.session_id, speculation["job_id"])
+        if job is not None and not job.done:
+            print("Cancelling a reply started for cards that weren't submitted")
+            job.cancel()
+
+
+def _claim_speculation(inputs: dict) -> Optional[GenerationJob]:
+    """The speculative job started for exactly this prompt, if there is one; any other is cancelled."""
+    speculation = st.session_state.get("speculation")
+    if speculation is None or speculation["fingerprint"] != prompt_fingerprint(
+        [inputs]
+    ):
+        _cancel_speculation()
+        return None
+    del st.session_state.speculation
+    job = _jobs().get(st.session_state.session_id, speculation["job_id"])
+    if job is not None and job.cancelled.is_set():
+        return None
+    if job is not None:
+        saved = (job.finished_at or time.monotonic()) - job.submitted_at
+        SPECULATION_SECONDS_SAVED.inc(saved)
+        print(f"Using the reply started {saved:.2f}s before Submit")
+    return job
+
+
+def _follow(speculative: GenerationJob, job: GenerationJob):
+    while not speculative.done:
+        job.set_queue_position(speculative.queue_position)
+        job.show(speculative.visible)
+        time.sleep(0.05)
+    job.set_queue_position(None)
+    job.show(speculative.visible)
+    try:
+        response, discarded, prompt = speculative.future.result()
+    except CompletionFailed as e:
+        SPECULATIVE_TOKENS.inc(_spent_tokens(None, e.discarded), outcome="used")
+        raise
+    SPECULATIVE_TOKENS.inc(_spent_tokens(response, discarded), outcome="used")
+    return response, discarded, prompt
+
+
+def _start_generation(chat_session: ChatSession, job_id: str, moderation: Future):
+    """Generate the next reply on the job runner, and record it in the saved session when it arrives.
+
+    If a moderation check is in flight it must pass before the reply is shown or kept. The reply is written to
+    the store by the job itself, so it isn't lost if nobody is waiting on the page when it arrives.
+    """
+    session_id = st.session_state.session_id
+    inputs = _prompt_inputs(chat_session)
+    # a reply started when the last card was pulled, only ever for turns without answers to moderate
+    speculative = None
+    if moderation is None:
+        speculative = _claim_speculation(inputs)
+    else:
+        _cancel_speculation()
+    completions = _completions()
+    router = _router()
+    history_len = len(chat_session.history)
+    counts = {
+        "total_tokens_used": st.session_state.total_tokens_used,
+        "discarded_responses": st.session_state.discarded_responses,
+        "discarded_tokens": st.session_state.discarded_tokens,
+    }
+
+    @LLM_SECONDS.time()
+    def generate(job):
+        started = time.monotonic()
+        prompt = None
+        try:
+            if speculative is not None:
+                response, discarded, prompt = _follow(speculative, job)
+            else:
+                messages, prompt = _build_prompt(inputs, router)
+                response, discarded = completions.run(
+                    messages,
+                    stream=STREAM_RESPONSES,
+                    on_update=job.show,
+                    gate=moderation,
+                    on_queue=job.set_queue_position,
+                    turn_type=_turn_type(messages),
+                    on_late_response=job.add_late_response,
+                )
+        except CompletionFailed as e:
+            _persist_generation(session_id, history_len, counts, e.discarded, prompt)
+            e.prompt = prompt
+            raise
+        except FlaggedInputError:
+            _session_store().append(
+                session_id, [{"set": {"flagged_input": True}, "unset": ["pending_job"]}]
+            )
+            raise
+        except Exception as e:
+            # e.g. the moderation check couldn't be made; the page takes the turn back to be submitted again
+            _persist_generation(session_id, history_len, counts, [], prompt)
+            e.prompt = prompt
+            raise
+        _persist_generation(
+            session_id, history_len, counts, discarded, prompt, response
         )
+        moderation_time = moderation.result() if moderation is not None else None
+        return response, discarded, prompt, moderation_time, time.monotonic() - started
+
+    # saved before the job starts, so the job's own record of the reply always comes after it
+    st.session_state.pending_job = job_id
+    save_session()
+    _jobs().submit(session_id, job_id, generate)
+
+
+def _persist_generation(
+    session_id: str,
+    history_len: int,
+    counts: dict,
+    discarded: list,
+    prompt: Optional[dict],
+    response: dict = None,
+):
+    # runs on the job thread, so it writes journal records directly instead of going through session state;
+    # they match what the page records when it collects the reply, so writing both is harmless
+    DiagnosticsLog(DIAGNOSTICS_DIR, "bad_responses").append(session_id, discarded)
+    discarded_tokens = sum(r["usage"]["total_tokens"] for r in discarded)
+    record = {
+        "set": {
+            "total_tokens_used": counts["total_tokens_used"] + discarded_tokens,
+            "discarded_responses": counts["discarded_responses"] + len(discarded),
+            "discarded_tokens": counts["discarded_tokens"] + discarded_tokens,
+        },
+        "unset": ["pending_job"],
+    }
+    if prompt is not None:
+        record["set"]["total_tokens_used"] += prompt["summary_tokens"]
+        if prompt["history_summary"] is None:
+            record["unset"].append("history_summary")
+        else:
+            record["set"]["history_summary"] = prompt["history_summary"]
+    if response is not None:
+        record["set"]["total_tokens_used"] += response["usage"]["total_tokens"]
+        message = {
+            "role": "assistant",
+            "content": response["choices"][0]["message"]["content"],
+        }
+        record["extend"] = {"chat_history": [history_len, [message]]}
+    _session_store().append(session_id, [record])
+
+
+def _latest_answer(history: list) -> Optional[str]:
+    """The user's message since the last assistant turn (it may be followed by the selected cards), if any."""
+    for msg in reversed(history):
+        if msg["role"] == "assistant":
+            return None
+        if msg["role"] == "user":
+            return msg["content"]
+    return None
+
+
+def _await_generation(chat_session: ChatSession):
+    job_id = st.session_state.pending_job
+    session_id = st.session_state.session_id
+    job = _jobs().get(session_id, job_id)
+    if job is None:
+        saved = _session_store().load(session_id)
+        if saved is not None and saved.get("pending_job") != job_id:
+            # the reply was already saved, by a job that has since been cleaned up or ran in another process
+            _restore_session(session_id, saved)
+            st.session_state.pop("pending_job", None)
+            st.experimental_rerun()
+        # the process that was generating the reply has gone, so start again
+        print("Resuming a reading whose reply was lost")
+        # the check the lost job waited on went with it
+        moderation = None
+        answer = _latest_answer(chat_session.history)
+        if answer is not None:
+            moderation = _executor().submit(_moderate, answer, _moderator())
+        _start_generation(chat_session, job_id, moderation)
+        job = _jobs().get(session_id, job_id)
+
+    queue_status = st.empty()
+    stream_to = st.empty()
+    shown = None
+    with st.spinner("Generating AI response"):
+        while not job.done:
+            _show_queue_position(queue_status, job.queue_position)
+            if job.visible != shown:
+                stream_to.markdown(job.visible)
+                shown = job.visible
+            time.sleep(0.1)
+    # the job stays with the runner for a while, so another page open on this session collects the same reply
+    del st.session_state.pending_job
+
+    try:
+        (
+            response,
+            discarded,
+            prompt,
+            moderation_time,
+            generation_time,
+        ) = job.future.result()
+    except CompletionFailed as e:
+        print("Out of attempts")
+        _apply_prompt(getattr(e, "prompt", None))
+        # a cancelled reply may have sent nothing at all
+        COMPLETION_RETRIES.inc(max(0, len(e.discarded) - 1))
+        _record_bad_responses(e.discarded)
+        save_session()
+        st.error("Encountered an error generating your reading, sorry about that")
+        return
+    except (Overloaded, startup.openai_module().error.OpenAIError) as e:
+        # the moderation check was turned away or failed, so nothing was said that can't be said again
+        print(f"Couldn't check the querent's answers ({e!r})")
+        _apply_prompt(getattr(e, "prompt", None))
+        _take_back_turn(chat_session)
+        save_session()
+        # shown above the form on the next run, which asks for the turn again
+        st.session_state.busy_warning = True
+        st.experimental_rerun()
+    _apply_prompt(prompt)
+    if moderation_time is not None:
+        _record_overlap(moderation_time, generation_time)
+    COMPLETION_RETRIES.inc(len(discarded))
+    _record_bad_responses(discarded)
+    _add_tokens(response)
+
+    chat_session.assistant_says(response["choices"][0]["message"]["content"])
+
+    # the job has already saved the reply, so only what the page changed besides it still needs writing
+    get_session_writer(_session_store()).track(
+        session_id, _persisted_state(), appended=True
+    )
+    save_session()
+    st.experimental_rerun()
+
+
+def _show_queue_position(placeholder, position):
+    if position is None:
+        placeholder.empty()
+    elif position == 1:
+        placeholder.info("Emily is finishing with another seeker, you're next")
     else:
-        chat_history.append({"role": "system", "content": REINFORCEMENT_SYSTEM_MSG})
+        placeholder.info(
+            f"Emily is with other seekers right now, you're number {position} in line"
+        )
+
 
-    return openai.ChatCompletion.create(
-        # model="gpt-3.5-turbo-0613",
-        model="gpt-4o-mini",
-        messages=chat_history,
+def _summarize_history(messages: list, router: ModelRouter) -> dict:
+    speakers = {"assistant": "Emily", "user": "Querent", "system": "Note"}
+    transcript = "\n\n".join(
+        f"{speakers[msg['role']]}: {msg['content']}" for msg in messages
+    )
+    summary_request = [
+        {"role": "system", "content": SUMMARY_SYSTEM_MSG},
+        {"role": "user", "content": transcript},
+    ]
+    _admit_completion(summary_request, None, None)
+    model, max_tokens = router.choose("summary")
+    started = time.monotonic()
+    try:
+        response = _completion_request(
+            summary_request, False, COMPLETION_TIMEOUT, model, max_tokens
+        )
+    except Exception:
+        router.record("summary", model, False)
+        raise
+    router.record("summary", model, True, time.monotonic() - started)
+    TOKENS.inc(response["usage"]["total_tokens"], model=response.get("model") or model)
+    return response
+
+
+def _turn_type(messages: list) -> str:
+    # the prompt ends with the reinforcement message, which says whether the cards are being read
+    if messages[-1]["content"] == CARDS_REINFORCEMENT_SYSTEM_MSG:
+        return "cards"
+    return "question"
+
+
+def _completion_request(
+    messages: list,
+    stream: bool,
+    timeout: float,
+    model: str,
+    max_tokens: Optional[int] = None,
+):
+    limits = {"max_tokens": max_tokens} if max_tokens else {}
+    return startup.openai_module().ChatCompletion.create(
+        model=model,
+        messages=messages,
+        stream=stream,
+        request_timeout=timeout,
+        **limits,
     )
 
 
-init_state()
+profiler = StackSampler().start() if _profiling_requested() else None
+_metrics_server()
+_session_sweeper()
+shared_reading, preloaded = _shared_reading()
+if shared_reading is None:
+    init_state(preloaded)
+    if PROFILE_SECRET:
+        st.session_state.profiling = profiler is not None
 try:
-    if "flagged_input" in st.session_state:
+    if shared_reading is not None:
+        _show_frozen(shared_reading)
+        _show_footer()
+    elif "flagged_input" in st.session_state:
         st.write("This session has been terminated")
         st.write(
             "I'm really sorry that you're feeling this way, but I'm unable to provide the help that you need. "
@@ -386,15 +1172,20 @@ try:
         st.write("**Remember, you're not alone. There are people who want to help.**")
     else:
         main()
-        st.caption(
-            "All art and text generated by Artificial Intelligence - for entertainment purposes only"
-        )
-        st.caption("View on [Github](https://github.com/msull/emilytarot)")
+        _show_footer()
 
         with st.expander("Session State", expanded=False):
             st.write(st.session_state)
 except FlaggedInputError:
+    FLAGGED_INPUTS.inc()
     st.error("FLAGGED INPUT RECEIVED")
+    st.session_state.pop("pending_job", None)
     st.session_state.flagged_input = True
     save_session()
     st.experimental_rerun()
+finally:
+    SCRIPT_RUN_SECONDS.observe(time.perf_counter() - script_started)
+    startup.report_first_render(script_started)
+    if profiler is not None:
+        _write_profile(profiler)
+    _warm_up()
@@ -0,0 +1,81 @@
+import re
+
+import pytest
+
+from utils.commands import (
+    PULL_CARDS_PREFIX,
+    QUESTION_PREFIX,
+    CommandStreamFilter,
+    extract_commands,
+)
+from utils.messages import INTROS
+
+REPLY = (
+    "Welcome back.\n\n"
+    "The cards are ready.\n\n"
+    "QUESTION: What is your name?\n"
+    "QUESTION: What brings you here?\n\n"
+    "PULL TAROT CARDS: 3\n"
+)
+
+
+def _old_cleaned_content(content: str) -> str:
+    # extract_commands' cleaned_content as it was before parsed turns were stored with the session
+    remove_lines = [
+        line
+        for line in content.splitlines()
+        if line.startswith(QUESTION_PREFIX) or line.startswith(PULL_CARDS_PREFIX)
+    ]
+    for line in remove_lines:
+        content = content.replace(line, "")
+    return content.replace("\n\n\n", "\n\n")
+
+
+def _as_rendered(markdown: str) -> str:
+    # markdown treats any run of blank lines as one, and ignores them at either end
+    return re.sub(r"\n{3,}", "\n\n", markdown).strip()
+
+
+def _feed(stream_filter: CommandStreamFilter, text: str, size: int):
+    visible = []
+    for start in range(0, len(text), size):
+        stream_filter.feed(text[start : start + size])
+        visible.append(stream_filter.visible)
+    return visible
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 16])
+def test_command_lines_never_visible(size):
+    stream_filter = CommandStreamFilter()
+    for visible in _feed(stream_filter, REPLY, size):
+        assert "QUESTION" not in visible
+        assert "PULL" not in visible
+        # nothing from a command line leaks either, however it was split
+        assert "TAROT CARDS" not in visible
+        assert "name?" not in visible
+    assert stream_filter.visible == "Welcome back.\n\nThe cards are ready.\n"
+
+
+@pytest.mark.parametrize("size", [1, 4, 50])
+def test_malformed_pull_raises_when_line_completes(size):
+    stream_filter = CommandStreamFilter()
+    _feed(stream_filter, "Let's draw.\n\nPULL TAROT CARDS: a few", size)
+    with pytest.raises(ValueError):
+        stream_filter.feed("\n")
+
+
+@pytest.mark.parametrize("content", [REPLY, REPLY.rstrip("\n")] + INTROS)
+@pytest.mark.parametrize("size", [1, 3, 11])
+def test_finish_matches_extract_commands(content, size):
+    stream_filter = CommandStreamFilter()
+    _feed(stream_filter, content, size)
+    assert stream_filter.finish() == extract_commands(content)
+
+
+@pytest.mark.parametrize("intro", INTROS)
+def test_cleaned_content_renders_as_before(intro):
+    commands = extract_commands(intro)
+    assert commands.questions_to_ask
+    assert _as_rendered(commands.cleaned_content) == _as_rendered(
+        _old_cleaned_content(intro)
+    )
@@ -0,0 +1,186 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import openai
+import pytest
+
+from utils import completions
+from utils.completions import (
+    CompletionFailed,
+    FlaggedInputError,
+    LatencyTracker,
+    ResilientCompletion,
+)
+
+GOOD = "Thank you.\n\nQUESTION: What worries you?"
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def _response(content=GOOD, finish_reason="stop", completion_tokens=10):
+    return {
+        "model": "fake",
+        "choices": [
+            {
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }
+        ],
+        "usage": {
+            "prompt_tokens": 5,
+            "completion_tokens": completion_tokens,
+            "total_tokens": 5 + completion_tokens,
+        },
+    }
+
+
+class FakeCreate:
+    """Plays back one scripted outcome per request: a response, an exception, or a callable to run first."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, messages, stream, timeout):
+        with self._lock:
+            self.calls.append(time.monotonic())
+            outcome = self.outcomes.pop(0)
+        if callable(outcome):
+            outcome = outcome()
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(4) as pool:
+        yield pool
+
+
+@pytest.fixture(autouse=True)
+def fresh_latencies(monkeypatch):
+    # the trackers are shared by the process; keep earlier tests' latencies out of the hedge delay
+    monkeypatch.setattr(completions, "TOTAL_LATENCY", LatencyTracker())
+    monkeypatch.setattr(completions, "FIRST_TOKEN_LATENCY", LatencyTracker())
+
+
+def _completion(create, executor, **kwargs):
+    kwargs.setdefault("poll_interval", 0.01)
+    return ResilientCompletion(create, executor, **kwargs)
+
+
+def _slow(seconds, response):
+    def wait():
+        time.sleep(seconds)
+        return response
+
+    return wait
+
+
+def test_hedge_sent_after_threshold_and_winner_cancels_loser(executor):
+    create = FakeCreate(_slow(1.0, _response()), _response(completion_tokens=3))
+    completion = _completion(
+        create, executor, default_hedge_delay=0.2, min_hedge_delay=0.2
+    )
+
+    response, discarded = completion.run(MESSAGES)
+
+    assert len(create.calls) == 2
+    assert create.calls[1] - create.calls[0] >= 0.2
+    assert response["usage"]["completion_tokens"] == 3
+    assert [r["error"] for r in discarded] == ["cancelled"]
+
+
+def test_no_hedge_before_threshold(executor):
+    create = FakeCreate(_slow(0.1, _response()), _response())
+    completion = _completion(
+        create, executor, default_hedge_delay=1.0, min_hedge_delay=1.0
+    )
+
+    response, discarded = completion.run(MESSAGES)
+
+    assert len(create.calls) == 1
+    assert discarded == []
+
+
+def test_late_response_of_abandoned_attempt_is_reported(executor):
+    create = FakeCreate(
+        _slow(0.5, _response(completion_tokens=40)), _response(completion_tokens=3)
+    )
+    completion = _completion(
+        create, executor, default_hedge_delay=0.1, min_hedge_delay=0.1
+    )
+    late = []
+    arrived = threading.Event()
+
+    def on_late_response(response):
+        late.append(response)
+        arrived.set()
+
+    response, discarded = completion.run(MESSAGES, on_late_response=on_late_response)
+
+    assert discarded[0]["usage"]["completion_tokens"] == 0
+    assert arrived.wait(2)
+    recorded, reported = discarded[0]["usage"], late[0]["usage"]
+    assert recorded["prompt_tokens"] + reported["prompt_tokens"] == 5
+    assert reported["completion_tokens"] == 40
+    assert recorded["total_tokens"] + reported["total_tokens"] == 45
+
+
+def test_rate_limited_attempt_backs_off(executor, monkeypatch):
+    monkeypatch.setattr(completions.random, "uniform", lambda low, high: high)
+    create = FakeCreate(openai.error.RateLimitError("slow down"), _response())
+    completion = _completion(create, executor, backoff_base=0.1, backoff_cap=0.3)
+
+    response, discarded = completion.run(MESSAGES)
+
+    assert len(create.calls) == 2
+    # the first rate limit waits backoff_base * 2
+    assert create.calls[1] - create.calls[0] >= 0.2
+    assert "RateLimitError" in discarded[0]["error"]
+
+
+def test_truncated_and_empty_replies_are_retried(executor):
+    create = FakeCreate(
+        _response(finish_reason="length"), _response(content=""), _response()
+    )
+    completion = _completion(create, executor)
+
+    response, discarded = completion.run(MESSAGES)
+
+    assert len(create.calls) == 3
+    assert response["choices"][0]["message"]["content"] == GOOD
+    assert len(discarded) == 2
+
+
+def test_out_of_attempts(executor):
+    create = FakeCreate(*[_response(content="")] * 3)
+    completion = _completion(create, executor, max_attempts=3)
+
+    with pytest.raises(CompletionFailed) as failed:
+        completion.run(MESSAGES)
+    assert len(failed.value.discarded) == 3
+
+
+def test_flagged_gate_cancels_live_attempts(executor):
+    streamed = []
+
+    def stream():
+        for i in range(50):
+            streamed.append(i)
+            time.sleep(0.02)
+            yield {"choices": [{"delta": {"content": "word "}, "finish_reason": None}]}
+
+    create = FakeCreate(stream)
+    completion = _completion(create, executor)
+    gate = Future()
+    threading.Timer(0.1, gate.set_exception, (FlaggedInputError(),)).start()
+
+    with pytest.raises(FlaggedInputError):
+        completion.run(MESSAGES, stream=True, gate=gate)
+    time.sleep(0.1)
+    stopped_at = len(streamed)
+    time.sleep(0.1)
+    assert len(streamed) == stopped_at < 50
@@ -0,0 +1,101 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from utils.moderation import ModerationBatcher
+
+
+class FakeRequest:
+    """Flags inputs containing "kill"; fails for inputs containing "bad", and for batches when `batches_fail`."""
+
+    def __init__(self, batches_fail: bool = False):
+        self.batches_fail = batches_fail
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, inputs):
+        with self._lock:
+            self.calls.append(sorted(inputs))
+        if self.batches_fail and len(inputs) > 1:
+            raise RuntimeError("batch failed")
+        if any("bad" in text for text in inputs):
+            raise RuntimeError("input failed")
+        return ["kill" in text for text in inputs]
+
+
+def _together(batcher: ModerationBatcher, texts):
+    # checks started together, well within the batch window
+    with ThreadPoolExecutor(len(texts)) as pool:
+        futures = [pool.submit(batcher.flagged, text) for text in texts]
+    return futures
+
+
+def test_batch_failure_falls_back_to_each_input():
+    request = FakeRequest(batches_fail=True)
+    batcher = ModerationBatcher(request, window=0.2)
+
+    futures = _together(batcher, ["hello", "I will kill"])
+
+    assert [f.result() for f in futures] == [False, True]
+    assert request.calls[0] == ["I will kill", "hello"]
+    assert sorted(request.calls[1:]) == [["I will kill"], ["hello"]]
+
+
+def test_input_failure_raises_to_its_caller_only():
+    request = FakeRequest()
+    batcher = ModerationBatcher(request, window=0.2)
+
+    ok, bad = _together(batcher, ["hello", "bad input"])
+
+    assert ok.result() is False
+    with pytest.raises(RuntimeError, match="input failed"):
+        bad.result()
+    # the failure isn't cached: the next check asks again
+    with pytest.raises(RuntimeError):
+        batcher.flagged("bad input")
+    assert request.calls[-1] == ["bad input"]
+
+
+def test_identical_inputs_share_one_check():
+    request = FakeRequest()
+    batcher = ModerationBatcher(request, window=0.2)
+
+    futures = _together(batcher, ["same"] * 4)
+
+    assert [f.result() for f in futures] == [False] * 4
+    assert request.calls == [["same"]]
+
+
+def test_cached_verdicts_expire():
+    request = FakeRequest()
+    hits = []
+    batcher = ModerationBatcher(
+        request, window=0.01, cache_ttl=0.3, on_cache_hit=lambda: hits.append(1)
+    )
+
+    batcher.flagged("hello")
+    batcher.flagged("hello")
+    assert len(request.calls) == 1
+    assert len(hits) == 1
+
+    time.sleep(0.4)
+    batcher.flagged("hello")
+    assert len(request.calls) == 2
+
+
+def test_least_recently_used_verdict_is_evicted():
+    request = FakeRequest()
+    batcher = ModerationBatcher(request, window=0.01, cache_size=2)
+
+    batcher.flagged("a")
+    batcher.flagged("b")
+    batcher.flagged("a")
+    batcher.flagged("c")
+    assert request.calls == [["a"], ["b"], ["c"]]
+
+    batcher.flagged("a")
+    assert len(request.calls) == 3
+    batcher.flagged("b")
+    assert request.calls[-1] == ["b"]
@@ -0,0 +1,91 @@
+import json
+
+from utils.context import build_prompt
+from utils.session_schema import SCHEMA_VERSION, apply_journal, decode, encode, upgrade
+
+
+def _session():
+    return {
+        "session_id": "2023070112abcdef",
+        "reading_in_progress": True,
+        "started_chat": True,
+        "card_draw_type": "Draw cards virtually",
+        "chat_history": [
+            {"role": "assistant", "content": "Welcome.\n\nQUESTION: Your name?"},
+            {"role": "user", "content": "Bob"},
+            {"role": "assistant", "content": "Thanks.\n\nQUESTION: Your question?"},
+            {"role": "user", "content": "My job"},
+        ],
+        "history_summary": {"upto": 1, "text": "Bob introduced himself."},
+        "drawn_cards": 0b101,
+        "chosen_virtual_cards": [3],
+        "deck_seed": "abc",
+        "deck_position": 2,
+        "total_tokens_used": 1234,
+        "discarded_responses": 1,
+        "discarded_tokens": 50,
+        "pending_job": "job-1",
+        "header_images": ["images/a.png", "images/b.png", "images/c.png"],
+        "emily_image": "images/emily.png",
+        "closing_image": "images/d.png",
+    }
+
+
+def test_encode_decode_round_trip():
+    data = _session()
+    stored = json.loads(encode(data))
+    assert stored["v"] == SCHEMA_VERSION
+    assert decode(stored) == data
+
+
+def test_summary_survives_reload_into_build_prompt():
+    data = decode(json.loads(encode(_session())))
+    messages, summary = build_prompt(
+        data["chat_history"],
+        "system",
+        "reinforcement",
+        budget=10_000,
+        summary=data["history_summary"],
+        summarize=lambda messages: "unused",
+    )
+    assert summary == {"upto": 1, "text": "Bob introduced himself."}
+    assert "Bob introduced himself." in messages[1]["content"]
+
+
+def test_journal_replay_is_idempotent():
+    data = _session()
+    stored = json.loads(encode(data))
+    reply = {"role": "assistant", "content": "The cards speak."}
+    records = [
+        {
+            "set": {"history_summary": {"upto": 4, "text": "Longer summary."}},
+            "unset": ["pending_job"],
+            "extend": {"chat_history": [4, [reply]]},
+        }
+    ]
+    once = decode(stored, records)
+    twice = decode(stored, records + records)
+    assert once == twice
+    assert once["chat_history"][-1] == reply
+    assert once["history_summary"] == {"upto": 4, "text": "Longer summary."}
+    assert "pending_job" not in once
+    assert apply_journal({}, records)["chat_history"] == [reply]
+
+
+def test_upgrade_converts_version_1_sessions():
+    legacy = {
+        "session_id": "2023070112abcdef",
+        "chat_history": [{"role": "assistant", "content": "Welcome."}],
+        "all_chosen_cards": ["The Fool", "The Magician"],
+        "chosen_virtual_cards": ["The Magician"],
+        "bad_responses": [
+            {"usage": {"total_tokens": 7}},
+            {"usage": {"total_tokens": 3}},
+        ],
+        "chat_turns": [None],
+    }
+    data = upgrade(legacy)
+    assert data["drawn_cards"] == 0b11
+    assert data["chosen_virtual_cards"] == [1]
+    assert (data["discarded_responses"], data["discarded_tokens"]) == (2, 10)
+    assert "chat_turns" not in data
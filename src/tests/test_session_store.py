@@ -0,0 +1,52 @@
+import threading
+
+import pytest
+
+from utils import session_store
+from utils.session_store import FileSessionStore, SqliteSessionStore
+
+SESSION_ID = "2023070112abcdef"
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "file":
+        return FileSessionStore(tmp_path, sharded=True)
+    return SqliteSessionStore(tmp_path / "sessions.db")
+
+
+def _session():
+    return {"session_id": SESSION_ID, "chat_history": [], "total_tokens_used": 0}
+
+
+def test_compact_folds_journal(store):
+    store.save(SESSION_ID, _session())
+    store.append(SESSION_ID, [{"set": {"total_tokens_used": 10}}])
+    store.compact(SESSION_ID)
+    assert store._load_stored(SESSION_ID)[1] == []
+    assert store.load(SESSION_ID)["total_tokens_used"] == 10
+
+
+def test_compact_keeps_records_appended_meanwhile(store, monkeypatch):
+    store.save(SESSION_ID, _session())
+    store.append(SESSION_ID, [{"set": {"total_tokens_used": 10}}])
+    decode = session_store.decode
+    appender = []
+
+    def decode_then_append(*args):
+        # another writer appends after compaction has read the journal
+        appender.append(
+            threading.Thread(
+                target=store.append,
+                args=(SESSION_ID, [{"set": {"total_tokens_used": 20}}]),
+            )
+        )
+        appender[0].start()
+        appender[0].join(0.2)
+        return decode(*args)
+
+    monkeypatch.setattr(session_store, "decode", decode_then_append)
+    store.compact(SESSION_ID)
+    appender[0].join()
+    monkeypatch.setattr(session_store, "decode", decode)
+    assert store.load(SESSION_ID)["total_tokens_used"] == 20
@@ -0,0 +1,88 @@
+from dataclasses import dataclass
+from typing import List
+
+QUESTION_PREFIX = "QUESTION: "
+PULL_CARDS_PREFIX = "PULL TAROT CARDS"
+COMMAND_PREFIXES = (QUESTION_PREFIX, PULL_CARDS_PREFIX)
+
+
+@dataclass
+class AiCommands:
+    questions_to_ask: List[str]
+    draw_cards: int
+    cleaned_content: str
+
+
+def _parse_pull_cards(line: str) -> int:
+    _, num_cards_str = line.split(":")
+    return int(num_cards_str)
+
+
+def _keep_line(lines: List[str], line: str):
+    # drop blank lines at the start and collapse runs of them, which removed command lines tend to leave
+    if line or (lines and lines[-1]):
+        lines.append(line)
+
+
+def extract_commands(content: str) -> AiCommands:
+    """Extract questions and number of cards to draw from the message; return the cleaned string without those cmds."""
+    num_cards = 0
+    questions = []
+    kept = []
+    for line in content.splitlines():
+        if line.startswith(QUESTION_PREFIX):
+            questions.append(line.removeprefix(QUESTION_PREFIX))
+        elif line.startswith(PULL_CARDS_PREFIX):
+            num_cards += _parse_pull_cards(line)
+        else:
+            _keep_line(kept, line)
+
+    return AiCommands(
+        questions_to_ask=questions,
+        draw_cards=num_cards,
+        cleaned_content="\n".join(kept),
+    )
+
+
+def _may_become_command(partial_line: str) -> bool:
+    return any(
+        prefix.startswith(partial_line) or partial_line.startswith(prefix)
+        for prefix in COMMAND_PREFIXES
+    )
+
+
+class CommandStreamFilter:
+    """Incremental counterpart to extract_commands for streamed messages.
+
+    Text is fed in as it arrives; `visible` only ever contains lines that can no longer turn into a command,
+    so QUESTION / PULL TAROT CARDS lines are never shown while the message is still streaming.
+    A malformed command line raises ValueError as soon as it is complete, so a bad stream can be abandoned early.
+    """
+
+    def __init__(self):
+        self.content = ""
+        self._visible_lines = []
+        self._partial_line = ""
+
+    def feed(self, text: str):
+        self.content += text
+        self._partial_line += text
+        while "\n" in self._partial_line:
+            line, self._partial_line = self._partial_line.split("\n", 1)
+            self._complete_line(line)
+
+    def _complete_line(self, line: str):
+        if line.startswith(PULL_CARDS_PREFIX):
+            _parse_pull_cards(line)
+        elif not line.startswith(QUESTION_PREFIX):
+            _keep_line(self._visible_lines, line)
+
+    @property
+    def visible(self) -> str:
+        lines = self._visible_lines
+        if self._partial_line and not _may_become_command(self._partial_line):
+            lines = lines + [self._partial_line]
+        return "\n".join(lines)
+
+    def finish(self) -> AiCommands:
+        return extract_commands(self.content)
@@ -0,0 +1,438 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Callable, List, Optional, Tuple
+
+from utils.commands import CommandStreamFilter, extract_commands
+from utils.context import count_messages_tokens
+from utils.routing import ModelRouter
+from utils.startup import openai_module
+
+
+class CompletionFailed(RuntimeError):
+    def __init__(self, discarded: List[dict]):
+        super().__init__(f"No usable completion after {len(discarded)} attempts")
+        self.discarded = discarded
+
+
+class CompletionCancelled(CompletionFailed):
+    """The caller gave up on the reply; `discarded` holds what its attempts had used so far."""
+
+
+class FlaggedInputError(RuntimeError):
+    """Moderation flagged the user's message; defined here so it's the same class in every script run."""
+
+
+def estimate_tokens(messages: List[dict]) -> int:
+    return count_messages_tokens(messages)
+
+
+class LatencyTracker:
+    """Rolling window of recent latencies, shared by every session in the process."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+# a reply has at most this many requests in flight at once: the outstanding one and its hedge
+MAX_LIVE_ATTEMPTS = 2
+
+# streamed attempts are judged on time to first token, blocking ones on total time
+FIRST_TOKEN_LATENCY = LatencyTracker()
+TOTAL_LATENCY = LatencyTracker()
+
+
+class CompletionAttempt:
+    """A single request, run on a worker thread; streamed text accumulates on the attempt as it arrives."""
+
+    def __init__(
+        self,
+        create: Callable,
+        messages: List[dict],
+        stream: bool,
+        timeout,
+        admit: Callable = None,
+        model: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+    ):
+        self.create = create
+        self.messages = messages
+        self.stream = stream
+        self.timeout = timeout
+        self.admit = admit
+        self.model = model
+        self.max_tokens = max_tokens
+        self.queue_position = None
+        self.sent_at = None
+        self.first_token_at = None
+        self.completion_tokens = 0
+        self.stream_filter = CommandStreamFilter()
+        self.response = None
+        self.error = None
+        self.malformed = False
+        # the reply hit max_tokens, so its closing command line may be missing
+        self.truncated = False
+        self.future: Optional[Future] = None
+        self._cancelled = threading.Event()
+
+    def _set_queue_position(self, position: Optional[int]):
+        self.queue_position = position
+
+    def run(self):
+        try:
+            if self.admit is not None and not self.admit(
+                self.messages, self._set_queue_position, self._cancelled
+            ):
+                return
+            self.sent_at = time.monotonic()
+            if self.stream:
+                self._run_stream()
+            else:
+                self.response = self._create(stream=False)
+                self.first_token_at = time.monotonic()
+                self.truncated = (
+                    self.response["choices"][0].get("finish_reason") == "length"
+                )
+        except Exception as e:
+            self.error = e
+
+    def _create(self, stream: bool):
+        if self.model is None:
+            return self.create(self.messages, stream=stream, timeout=self.timeout)
+        return self.create(
+            self.messages,
+            stream=stream,
+            timeout=self.timeout,
+            model=self.model,
+            max_tokens=self.max_tokens,
+        )
+
+    def _run_stream(self):
+        for chunk in self._create(stream=True):
+            if self._cancelled.is_set():
+                return
+            if chunk["choices"][0].get("finish_reason") == "length":
+                self.truncated = True
+            text = chunk["choices"][0]["delta"].get("content")
+            if not text:
+                continue
+            if self.first_token_at is None:
+                self.first_token_at = time.monotonic()
+            self.completion_tokens += 1
+            try:
+                self.stream_filter.feed(text)
+            except ValueError:
+                # abandon the stream as soon as a command line turns out malformed
+                self.malformed = True
+                return
+
+    def cancel(self):
+        self._cancelled.set()
+        self.future.cancel()
+
+    @property
+    def done(self) -> bool:
+        return self.future.done()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def content(self) -> str:
+        if self.response is not None:
+            return self.response["choices"][0]["message"]["content"]
+        return self.stream_filter.content
+
+    def usable(self) -> bool:
+        if self.error is not None or self.malformed or self.cancelled:
+            return False
+        if self.truncated:
+            return False
+        if not self.content.strip():
+            # e.g. a stream that ended without any content
+            return False
+        try:
+            extract_commands(self.content)
+        except Exception:
+            return False
+        return True
+
+    def as_response(self) -> dict:
+        """The raw response, or for streamed/unfinished attempts one shaped like it, with estimated usage."""
+        if self.response is not None:
+            return self.response
+        prompt_tokens = estimate_tokens(self.messages) if self.sent_at else 0
+        response = {
+            "model": self.model,
+            "choices": [{"message": {"role": "assistant", "content": self.content}}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "total_tokens": prompt_tokens + self.completion_tokens,
+            },
+        }
+        if self.error is not None:
+            response["error"] = repr(self.error)
+        elif not self.done or self.cancelled:
+            response["error"] = "cancelled"
+        return response
+
+
+def _unreported(recorded: dict, late: dict) -> dict:
+    """The late response, with the usage its abandoned attempt was recorded with taken off."""
+    usage = {
+        key: late["usage"][key] - recorded["usage"][key]
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens")
+    }
+    return {**late, "usage": usage}
+
+
+class ResilientCompletion:
+    """Runs a completion with per-attempt deadlines, hedging and retries.
+
+    A duplicate request is sent once the outstanding one has gone longer than the recent `hedge_percentile`
+    latency without producing anything. The first attempt whose content parses wins and the rest are cancelled.
+    Rate limited attempts are retried after a jittered exponential backoff; other failures are retried at once,
+    up to `max_attempts` requests in total. Every attempt that doesn't win is returned so its usage can be counted.
+
+    If `admit` is given, each attempt passes through it (e.g. a RateLimiter queue) before being sent; deadlines
+    and hedging only start counting once a request has actually been sent. If `router` is given, each attempt
+    (retries and hedges included) asks it which model to use for the turn type, and reports back how it went;
+    retries prefer a model that hasn't failed yet for this reply. `on_first_token` is given each finished
+    attempt's time to first token (to the whole response when not streamed).
+    """
+
+    def __init__(
+        self,
+        create: Callable,
+        executor: Executor,
+        max_attempts: int = 3,
+        attempt_timeout: float = 60.0,
+        hedge_percentile: float = 0.95,
+        default_hedge_delay: float = 10.0,
+        min_hedge_delay: float = 2.0,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 20.0,
+        poll_interval: float = 0.05,
+        admit: Callable = None,
+        router: Optional[ModelRouter] = None,
+        on_first_token: Optional[Callable[[float], None]] = None,
+    ):
+        self.create = create
+        self.on_first_token = on_first_token
+        self.admit = admit
+        self.router = router
+        self.executor = executor
+        self.max_attempts = max_attempts
+        self.attempt_timeout = attempt_timeout
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.poll_interval = poll_interval
+
+    def _hedge_delay(self, latencies: LatencyTracker) -> float:
+        threshold = latencies.percentile(self.hedge_percentile)
+        if threshold is None:
+            threshold = self.default_hedge_delay
+        return max(threshold, self.min_hedge_delay)
+
+    def _backoff(self, rate_limited: int) -> float:
+        return random.uniform(
+            0, min(self.backoff_cap, self.backoff_base * 2**rate_limited)
+        )
+
+    def run(
+        self,
+        messages: List[dict],
+        stream: bool = False,
+        on_update: Callable[[str], None] = None,
+        gate: Future = None,
+        on_queue: Callable[[Optional[int]], None] = None,
+        turn_type: str = "default",
+        cancelled: threading.Event = None,
+        on_late_response: Callable[[dict], None] = None,
+    ) -> Tuple[dict, List[dict]]:
+        """Return the winning response and the responses of every discarded attempt.
+
+        Streamed text is passed to `on_update` once `gate` (e.g. a moderation check) has completed; its
+        exception, if any, is raised instead of returning a response. While no request has been sent yet,
+        `on_queue` is given the place in line of the first one waiting for admission, then None. Setting
+        `cancelled` stops every attempt and raises CompletionCancelled.
+
+        A blocking request can't be called back once sent, so an attempt abandoned meanwhile is returned with its
+        prompt's estimated usage only; if its response arrives after all, `on_late_response` is given it with the
+        usage that wasn't returned then.
+        """
+        latencies = FIRST_TOKEN_LATENCY if stream else TOTAL_LATENCY
+        hedge_delay = self._hedge_delay(latencies)
+        live: List[CompletionAttempt] = []
+        discarded = []
+        launched = 0
+        rate_limited = 0
+        next_launch_at = time.monotonic()
+        shown = ""
+        queue_position = None
+
+        failed_models = set()
+
+        def report(attempt: CompletionAttempt, ok: bool):
+            if self.router is None or attempt.sent_at is None:
+                return
+            if not ok:
+                failed_models.add(attempt.model)
+            latency = None
+            if attempt.first_token_at is not None:
+                latency = attempt.first_token_at - attempt.sent_at
+            self.router.record(turn_type, attempt.model, ok, latency)
+
+        def launch():
+            nonlocal launched
+            model = max_tokens = None
+            if self.router is not None:
+                # a retry goes to another model where the route has one
+                model, max_tokens = self.router.choose(turn_type, failed_models)
+            attempt = CompletionAttempt(
+                self.create,
+                messages,
+                stream,
+                timeout=self.attempt_timeout,
+                admit=self.admit,
+                model=model,
+                max_tokens=max_tokens,
+            )
+            attempt.future = self.executor.submit(attempt.run)
+            live.append(attempt)
+            launched += 1
+
+        def abandon(attempt: CompletionAttempt):
+            attempt.cancel()
+            recorded = attempt.as_response()
+            discarded.append(recorded)
+            if on_late_response is None or attempt.stream:
+                return
+
+            def collect(_):
+                late = attempt.response
+                if late is not None and late is not recorded:
+                    on_late_response(_unreported(recorded, late))
+
+            attempt.future.add_done_callback(collect)
+
+        try:
+            while True:
+                now = time.monotonic()
+                if gate is not None and gate.done():
+                    gate.result()
+                if cancelled is not None and cancelled.is_set():
+                    for attempt in live:
+                        abandon(attempt)
+                    live.clear()
+                    raise CompletionCancelled(discarded)
+
+                for attempt in [a for a in live if a.done]:
+                    live.remove(attempt)
+                    if attempt.first_token_at is not None:
+                        first_token = attempt.first_token_at - attempt.sent_at
+                        latencies.add(first_token)
+                        if self.on_first_token is not None:
+                            self.on_first_token(first_token)
+                    usable = attempt.usable()
+                    if not attempt.cancelled:
+                        report(attempt, usable)
+                    if usable:
+                        if gate is not None:
+                            gate.result()
+                        for loser in live:
+                            abandon(loser)
+                        live.clear()
+                        first_token = ""
+                        if attempt.first_token_at is not None:
+                            first_token = f"first token at {attempt.first_token_at - attempt.sent_at:.2f}s, "
+                        print(
+                            f"Completion after {now - attempt.sent_at:.2f}s, "
+                            f"{first_token}{launched} request(s)"
+                        )
+                        return attempt.as_response(), discarded
+                    reason = attempt.error or "bad content"
+                    if attempt.truncated:
+                        reason = f"cut off at max_tokens ({attempt.max_tokens})"
+                    print(f"Discarding completion attempt: {reason}")
+                    discarded.append(attempt.as_response())
+                    if isinstance(attempt.error, openai_module().error.RateLimitError):
+                        rate_limited += 1
+                        next_launch_at = now + self._backoff(rate_limited)
+
+                for attempt in live[:]:
+                    # streams only need to start within the deadline; the client's read timeout covers stalls
+                    if attempt.sent_at is None or (
+                        attempt.stream and attempt.first_token_at is not None
+                    ):
+                        continue
+                    if now - attempt.sent_at > self.attempt_timeout:
+                        print("Completion attempt timed out")
+                        report(attempt, False)
+                        live.remove(attempt)
+                        abandon(attempt)
+
+                if not live:
+                    if launched >= self.max_attempts:
+                        raise CompletionFailed(discarded)
+                    if now >= next_launch_at:
+                        launch()
+                elif (
+                    len(live) < MAX_LIVE_ATTEMPTS
+                    and launched < self.max_attempts
+                    and all(a.sent_at is not None for a in live)
+                    and not any(a.first_token_at for a in live)
+                    and now - min(a.sent_at for a in live) > hedge_delay
+                    and now >= next_launch_at
+                ):
+                    print(
+                        f"No response after {hedge_delay:.2f}s, sending a hedged request"
+                    )
+                    launch()
+
+                if on_queue is not None:
+                    positions = [
+                        a.queue_position for a in live if a.queue_position is not None
+                    ]
+                    waiting = None
+                    if positions and not any(a.sent_at for a in live):
+                        waiting = min(positions)
+                    if waiting != queue_position:
+                        on_queue(waiting)
+                        queue_position = waiting
+
+                if on_update is not None and (gate is None or gate.done()):
+                    streaming = [a for a in live if a.first_token_at is not None]
+                    visible = ""
+                    if streaming:
+                        leader = min(streaming, key=lambda a: a.first_token_at)
+                        visible = leader.stream_filter.visible
+                    if visible != shown:
+                        on_update(visible)
+                        shown = visible
+
+                time.sleep(self.poll_interval)
+        except BaseException:
+            for attempt in live:
+                attempt.cancel()
+            raise
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import re
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+from utils.messages import SELECTED_CARDS_PREFIX, SUMMARY_PREFIX
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# every chat message costs a few tokens of framing on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+_WORDS = re.compile(r"\w+|[^\w\s]")
+
+
+@lru_cache(maxsize=None)
+def _encoding():
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Tokens in `text`, using tiktoken when it is installed and a close local approximation otherwise."""
+    if tiktoken is not None and _encoding() is not None:
+        return len(_encoding().encode(text))
+    # roughly one token per short word or punctuation mark, more for long words
+    return sum(1 + len(word) // 8 for word in _WORDS.findall(text))
+
+
+def count_messages_tokens(messages: List[dict]) -> int:
+    return sum(
+        count_tokens(msg["content"]) + MESSAGE_OVERHEAD_TOKENS for msg in messages
+    )
+
+
+def prompt_fingerprint(messages: List[dict]) -> str:
+    """A short digest of a prompt; two requests with the same fingerprint get the same input."""
+    encoded = json.dumps(messages, sort_keys=True).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def is_cards_message(msg: dict) -> bool:
+    return msg["role"] == "system" and msg["content"].startswith(SELECTED_CARDS_PREFIX)
+
+
+def _latest_exchange_start(history: List[dict]) -> int:
+    for i in range(len(history) - 1, -1, -1):
+        if history[i]["role"] == "assistant":
+            if i and history[i - 1]["role"] == "user":
+                return i - 1
+            return i
+    return 0
+
+
+def _assemble(
+    history: List[dict], head: List[dict], tail: List[dict], summary: Optional[dict]
+) -> List[dict]:
+    if not summary:
+        return head + history + tail
+    upto = summary["upto"]
+    summary_msg = {"role": "system", "content": SUMMARY_PREFIX + summary["text"]}
+    cards = [msg for msg in history[:upto] if is_cards_message(msg)]
+    return head + [summary_msg] + cards + history[upto:] + tail
+
+
+def build_prompt(
+    history: List[dict],
+    system_msg: str,
+    reinforcement_msg: str,
+    budget: int,
+    summary: Optional[dict],
+    summarize: Callable[[List[dict]], str],
+) -> Tuple[List[dict], Optional[dict]]:
+    """Build the messages for the next completion, keeping them within `budget` tokens where possible.
+
+    The system prompts, the latest exchange and every selected-cards message are always sent verbatim. Older
+    turns are replaced by a rolling summary, `{"upto": <index into history>, "text": ...}`, which is only
+    extended (by calling `summarize`) when the prompt no longer fits; the caller stores the returned summary
+    so it is reused on later turns.
+    """
+    head = [{"role": "system", "content": system_msg}]
+    tail = [{"role": "system", "content": reinforcement_msg}]
+    keep_from = _latest_exchange_start(history)
+    if summary and summary["upto"] > keep_from:
+        # the history no longer matches the summary
+        summary = None
+
+    messages = _assemble(history, head, tail, summary)
+    if count_messages_tokens(messages) <= budget:
+        return messages, summary
+    upto = summary["upto"] if summary else 0
+    if upto >= keep_from:
+        print("Prompt is over the token budget but there is nothing left to summarize")
+        return messages, summary
+
+    to_summarize = history[upto:keep_from]
+    if summary:
+        to_summarize = [
+            {"role": "system", "content": SUMMARY_PREFIX + summary["text"]}
+        ] + to_summarize
+    summary = {"upto": keep_from, "text": summarize(to_summarize)}
+    messages = _assemble(history, head, tail, summary)
+    print(
+        f"Summarized {keep_from} messages, prompt is now {count_messages_tokens(messages)} tokens"
+    )
+    return messages, summary
@@ -0,0 +1,71 @@
+import hashlib
+from functools import lru_cache
+from typing import Iterable, List, Tuple
+
+from utils.tarot import TAROT_DECK
+
+# a card's id is its index in TAROT_DECK; sets of drawn cards are kept as bitmasks of those ids
+DECK_SIZE = len(TAROT_DECK)
+CARD_IDS = {name: card for card, name in enumerate(TAROT_DECK)}
+
+_MASK64 = (1 << 64) - 1
+
+
+def card_name(card: int) -> str:
+    return TAROT_DECK[card]
+
+
+def card_id(name: str) -> int:
+    return CARD_IDS[name]
+
+
+def to_mask(cards: Iterable[int]) -> int:
+    mask = 0
+    for card in cards:
+        mask |= 1 << card
+    return mask
+
+
+def from_mask(mask: int) -> List[int]:
+    return [card for card in range(DECK_SIZE) if mask >> card & 1]
+
+
+def splitmix64(x: int) -> int:
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+def seed_key(seed: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(seed.encode(), digest_size=8).digest(), "little"
+    )
+
+
+@lru_cache(maxsize=1024)
+def shuffled_order(seed: str) -> Tuple[int, ...]:
+    """The order of the deck after shuffling with `seed`: card ids sorted by splitmix64(key + id).
+
+    Keying every card independently (rather than running a sequential shuffle) means the same order can be
+    computed for many seeds at once with vectorised integer arithmetic.
+    """
+    key = seed_key(seed)
+    return tuple(
+        sorted(range(DECK_SIZE), key=lambda card: splitmix64((key + card) & _MASK64))
+    )
+
+
+def draw(seed: str, position: int, drawn: int) -> Tuple[int, int]:
+    """Draw the next card in `seed`'s order at or after `position` that isn't in the `drawn` mask.
+
+    Returns the card id and the position to resume from. Every card before `position` must already be drawn,
+    so cards are only skipped when they were drawn under a different seed.
+    """
+    order = shuffled_order(seed)
+    while position < DECK_SIZE:
+        card = order[position]
+        position += 1
+        if not drawn >> card & 1:
+            return card, position
+    raise ValueError("Every card in the deck has been drawn")
@@ -0,0 +1,39 @@
+import os
+import time
+from pathlib import Path
+from typing import List
+
+from utils.session_schema import dumps
+
+
+class DiagnosticsLog:
+    """Append-only JSON lines of raw payloads kept for debugging, one file per UTC day: `<kind>-YYYYMMDD.jsonl`.
+
+    Each line is `{"session_id", "at", "payload"}`. Every append is a single write to a file opened for appending,
+    so lines from concurrent writers (threads or processes) don't interleave.
+    """
+
+    def __init__(self, directory, kind: str):
+        self.directory = Path(directory)
+        self.kind = kind
+
+    def path(self, at: float) -> Path:
+        return (
+            self.directory
+            / f"{self.kind}-{time.strftime('%Y%m%d', time.gmtime(at))}.jsonl"
+        )
+
+    def append(self, session_id: str, payloads: List[dict], at: float = None):
+        if not payloads:
+            return
+        at = at or time.time()
+        lines = "".join(
+            dumps({"session_id": session_id, "at": at, "payload": payload}) + "\n"
+            for payload in payloads
+        )
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path(at), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode())
+        finally:
+            os.close(fd)
@@ -0,0 +1,199 @@
+"""Seeded card draws in bulk, to audit the shuffle and time it.
+
+Draws many spreads at once with the same seed-to-card semantics as `utils.deck.draw` (each seed's deck order is
+its cards sorted by splitmix64(key + id); cards already drawn are skipped), checks a sample against `draw`
+itself, and tests per-card and per-position frequencies for uniformity with chi-square tests.
+
+    python -m utils.draw_sim --spreads 1000000 --cards 3 --drawn 5 --output draws.json
+"""
+import argparse
+import hashlib
+import json
+import math
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import List, Sequence
+
+import numpy as np
+
+from utils.deck import DECK_SIZE, draw, from_mask, to_mask
+
+CHUNK_SPREADS = 65536
+
+_CARD_OFFSETS = np.arange(DECK_SIZE, dtype=np.uint64)
+
+
+def seed_keys(seeds: Sequence[str]) -> np.ndarray:
+    """`utils.deck.seed_key` of every seed, as uint64."""
+    digests = b"".join(
+        hashlib.blake2b(seed.encode(), digest_size=8).digest() for seed in seeds
+    )
+    return np.frombuffer(digests, dtype="<u8").astype(np.uint64)
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    # uint64 array arithmetic wraps around, which is the & _MASK64 of the scalar version
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def shuffled_orders(keys: np.ndarray) -> np.ndarray:
+    """One row per key: the deck order `utils.deck.shuffled_order` gives its seed."""
+    sort_keys = splitmix64(keys[:, None] + _CARD_OFFSETS)
+    # stable, like sorted(), should two cards ever share a sort key
+    return np.argsort(sort_keys, axis=1, kind="stable").astype(np.uint8)
+
+
+def draw_spreads(seeds: Sequence[str], cards: int, drawn: int = 0) -> np.ndarray:
+    """The `cards` cards pulled one after another for each seed, as `draw` would from position 0.
+
+    `drawn` is the mask of cards drawn earlier in the reading, which every pull skips.
+    """
+    allowed = np.ones(DECK_SIZE, dtype=bool)
+    allowed[from_mask(drawn)] = False
+    remaining = int(allowed.sum())
+    if cards > remaining:
+        raise ValueError(f"Only {remaining} cards are left to draw {cards} from")
+    orders = shuffled_orders(seed_keys(seeds))
+    # the same cards are missing from every row, so what's left is still one row per seed
+    return orders[allowed[orders]].reshape(len(seeds), remaining)[:, :cards]
+
+
+def scalar_spread(seed: str, cards: int, drawn: int = 0) -> List[int]:
+    """The same spread pulled the way the app does, one `draw` per card."""
+    spread = []
+    position = 0
+    for _ in range(cards):
+        card, position = draw(seed, position, drawn)
+        drawn |= 1 << card
+        spread.append(card)
+    return spread
+
+
+def chi2_sf(statistic: float, dof: int) -> float:
+    """Chance of a chi-square statistic at least this large (Wilson-Hilferty approximation, fine for dof >= 10)."""
+    z = ((statistic / dof) ** (1 / 3) - (1 - 2 / (9 * dof))) / math.sqrt(2 / (9 * dof))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def uniformity(counts: np.ndarray) -> dict:
+    """Chi-square test of `counts` against every entry being equally likely."""
+    expected = counts.sum() / len(counts)
+    statistic = float(((counts - expected) ** 2 / expected).sum())
+    dof = len(counts) - 1
+    return {
+        "chi2": round(statistic, 2),
+        "dof": dof,
+        "p_value": chi2_sf(statistic, dof),
+        "max_deviation": round(float(np.abs(counts / expected - 1).max()), 4),
+    }
+
+
+def simulate(
+    spreads: int, cards: int, drawn: int = 0, seed_prefix: str = "", verify: int = 1000
+) -> dict:
+    """Draw `spreads` spreads for the seeds `<seed_prefix>0`, `<seed_prefix>1`, ... and report on them."""
+    allowed = [card for card in range(DECK_SIZE) if not drawn >> card & 1]
+    card_counts = np.zeros(DECK_SIZE, dtype=np.int64)
+    position_counts = np.zeros((cards, DECK_SIZE), dtype=np.int64)
+    mismatches = []
+    batch_seconds = 0.0
+    scalar_seconds = 0.0
+
+    for start in range(0, spreads, CHUNK_SPREADS):
+        seeds = [
+            f"{seed_prefix}{i}"
+            for i in range(start, min(spreads, start + CHUNK_SPREADS))
+        ]
+        started = time.perf_counter()
+        chunk = draw_spreads(seeds, cards, drawn)
+        batch_seconds += time.perf_counter() - started
+
+        card_counts += np.bincount(chunk.ravel(), minlength=DECK_SIZE)
+        for position in range(cards):
+            position_counts[position] += np.bincount(
+                chunk[:, position], minlength=DECK_SIZE
+            )
+
+        checked = seeds[: max(0, verify - start)]
+        started = time.perf_counter()
+        expected = [scalar_spread(seed, cards, drawn) for seed in checked]
+        scalar_seconds += time.perf_counter() - started
+        for seed, row, spread in zip(checked, chunk, expected):
+            if row.tolist() != spread:
+                mismatches.append({"seed": seed, "batch": row.tolist(), "draw": spread})
+
+    checked = min(verify, spreads)
+    return {
+        "spreads": spreads,
+        "cards": cards,
+        "drawn": from_mask(drawn),
+        "seed_prefix": seed_prefix,
+        "batch_draws_per_second": round(spreads * cards / batch_seconds),
+        "scalar_draws_per_second": (
+            round(checked * cards / scalar_seconds) if checked else None
+        ),
+        "verified": checked,
+        "mismatches": mismatches[:10],
+        "mismatch_count": len(mismatches),
+        "drew_excluded": int(card_counts[from_mask(drawn)].sum()),
+        "cards_test": uniformity(card_counts[allowed]),
+        "position_tests": [uniformity(counts[allowed]) for counts in position_counts],
+    }
+
+
+def passed(report: dict, alpha: float) -> bool:
+    """No mismatch with `draw`, no excluded card drawn, and no uniformity test below `alpha` (Bonferroni corrected)."""
+    tests = [report["cards_test"]] + report["position_tests"]
+    return (
+        not report["mismatch_count"]
+        and not report["drew_excluded"]
+        and all(test["p_value"] >= alpha / len(tests) for test in tests)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Audit and time seeded card draws")
+    parser.add_argument("--spreads", type=int, default=1_000_000)
+    parser.add_argument("--cards", type=int, default=3, help="cards per spread")
+    parser.add_argument(
+        "--drawn",
+        type=int,
+        default=0,
+        help="how many cards (picked at random, the same for every spread) were drawn earlier in the reading",
+    )
+    parser.add_argument(
+        "--seed-prefix",
+        default="",
+        help="seeds are this followed by 0, 1, 2, ...; random unless given, to repeat a run",
+    )
+    parser.add_argument(
+        "--verify", type=int, default=1000, help="spreads to check against draw()"
+    )
+    parser.add_argument("--alpha", type=float, default=0.001)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    seed_prefix = args.seed_prefix or uuid.uuid4().hex + "-"
+    # the earlier cards follow from the seed prefix too, so a run repeats exactly
+    rng = np.random.default_rng(int(seed_keys([seed_prefix])[0]))
+    drawn = to_mask(rng.choice(DECK_SIZE, args.drawn, replace=False).tolist())
+    report = simulate(args.spreads, args.cards, drawn, seed_prefix, args.verify)
+    report["passed"] = passed(report, args.alpha)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+    speed = f"{report['batch_draws_per_second']:,} draws/s batched"
+    if report["scalar_draws_per_second"]:
+        speed += f", {report['scalar_draws_per_second']:,} draws/s one at a time"
+    print(
+        f"{report['spreads']} spreads of {report['cards']}: {speed}; "
+        f"{'passed' if report['passed'] else 'FAILED'}",
+        file=sys.stderr,
+    )
+    sys.exit(0 if report["passed"] else 1)
@@ -0,0 +1,348 @@
+# Export saved sessions to flat summary tables for analytics: sessions, turns, cards and token usage.
+# Run with `invoke export-sessions` (or `python -m utils.export_sessions --help` from src/), using the same
+# SESSION_DIR / SESSION_STORE / SESSION_DB settings as the app.
+# Sessions are read by a pool of worker processes and rows are written in batches as they come back, so memory
+# use doesn't grow with the size of the store. Writes Parquet when pyarrow is installed, otherwise CSV.
+# Each run only exports sessions it hasn't exported before, and only once they are finished: the reading is
+# over, or the session has not been touched for a day.
+import argparse
+import csv
+import json
+import os
+import time
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from utils.commands import extract_commands
+from utils.deck import CARD_IDS
+from utils.messages import SELECTED_CARDS_PREFIX
+from utils.session_store import get_session_store
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+STATE_FILE = ".export_state.json"
+IDLE_SECONDS = 24 * 60 * 60
+BATCH_ROWS = 5000
+
+TABLES = {
+    "sessions": {
+        "session_id": "string",
+        "date_id": "string",
+        "started_at": "string",
+        "card_draw_type": "string",
+        "messages": "int",
+        "user_turns": "int",
+        "assistant_turns": "int",
+        "cards_drawn": "int",
+        "total_tokens_used": "int",
+        "discarded_responses": "int",
+        "flagged_input": "bool",
+        "completed": "bool",
+    },
+    "turns": {
+        "session_id": "string",
+        "date_id": "string",
+        "turn": "int",
+        "role": "string",
+        "characters": "int",
+        "questions": "int",
+        "cards_requested": "int",
+    },
+    "cards": {
+        "session_id": "string",
+        "date_id": "string",
+        "position": "int",
+        "card_id": "int",
+        "card": "string",
+    },
+    "token_usage": {
+        "session_id": "string",
+        "date_id": "string",
+        "kind": "string",
+        "tokens": "int",
+    },
+}
+
+_store = None
+
+
+def _reading_over(history: List[dict]) -> bool:
+    if not history or history[-1]["role"] != "assistant":
+        return False
+    try:
+        commands = extract_commands(history[-1]["content"])
+    except ValueError:
+        return False
+    return not (commands.questions_to_ask or commands.draw_cards)
+
+
+def summarize_session(session_id: str, data: dict) -> Dict[str, List[dict]]:
+    """The rows each table gets for one session."""
+    date_id = session_id[:10]
+    history = data.get("chat_history", [])
+    discarded_tokens = data.get("discarded_tokens", 0)
+    total_tokens = data.get("total_tokens_used", 0)
+
+    turns = []
+    cards = []
+    for turn, msg in enumerate(history):
+        questions = cards_requested = 0
+        if msg["role"] == "assistant":
+            try:
+                commands = extract_commands(msg["content"])
+                questions = len(commands.questions_to_ask)
+                cards_requested = commands.draw_cards
+            except ValueError:
+                pass
+        elif msg["role"] == "system" and msg["content"].startswith(
+            SELECTED_CARDS_PREFIX
+        ):
+            names = msg["content"].removeprefix(SELECTED_CARDS_PREFIX).lstrip(": ")
+            for name in names.split(", "):
+                cards.append(
+                    {
+                        "session_id": session_id,
+                        "date_id": date_id,
+                        "position": len(cards) + 1,
+                        "card_id": CARD_IDS.get(name, -1),
+                        "card": name,
+                    }
+                )
+        turns.append(
+            {
+                "session_id": session_id,
+                "date_id": date_id,
+                "turn": turn,
+                "role": msg["role"],
+                "characters": len(msg["content"]),
+                "questions": questions,
+                "cards_requested": cards_requested,
+            }
+        )
+
+    try:
+        started_at = datetime.strptime(date_id, "%Y%m%d%H").isoformat()
+    except ValueError:
+        started_at = ""
+    flagged = bool(data.get("flagged_input"))
+    return {
+        "sessions": [
+            {
+                "session_id": session_id,
+                "date_id": date_id,
+                "started_at": started_at,
+                "card_draw_type": data.get("card_draw_type", ""),
+                "messages": len(history),
+                "user_turns": sum(1 for t in turns if t["role"] == "user"),
+                "assistant_turns": sum(1 for t in turns if t["role"] == "assistant"),
+                "cards_drawn": len(cards),
+                "total_tokens_used": total_tokens,
+                "discarded_responses": data.get("discarded_responses", 0),
+                "flagged_input": flagged,
+                "completed": flagged or _reading_over(history),
+            }
+        ],
+        "turns": turns,
+        "cards": cards,
+        "token_usage": [
+            {
+                "session_id": session_id,
+                "date_id": date_id,
+                "kind": "accepted",
+                "tokens": total_tokens - discarded_tokens,
+            },
+            {
+                "session_id": session_id,
+                "date_id": date_id,
+                "kind": "discarded",
+                "tokens": discarded_tokens,
+            },
+        ],
+    }
+
+
+def _init_worker(kind: str, session_dir: str, db_path: Optional[str]):
+    global _store
+    _store = get_session_store(kind, session_dir, db_path)
+
+
+def _export_one(task) -> Optional[Dict[str, List[dict]]]:
+    session_id, updated, now = task
+    data = _store.load(session_id)
+    if data is None:
+        return None
+    rows = summarize_session(session_id, data)
+    if not rows["sessions"][0]["completed"] and now - updated < IDLE_SECONDS:
+        # still in progress; picked up by a later run
+        return None
+    return rows
+
+
+class CsvTable:
+    def __init__(self, path: Path, columns: Dict[str, str], replace: bool = False):
+        new = replace or not path.exists()
+        self._file = open(path, "w" if replace else "a", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=list(columns))
+        if new:
+            self._writer.writeheader()
+
+    def write(self, rows: List[dict]):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetTable:
+    """One new part file per run in the table's directory, so the directory reads as a single dataset."""
+
+    TYPES = {
+        "string": lambda: pyarrow.string(),
+        "int": lambda: pyarrow.int64(),
+        "bool": lambda: pyarrow.bool_(),
+    }
+
+    def __init__(self, directory: Path, columns: Dict[str, str], replace: bool = False):
+        directory.mkdir(exist_ok=True)
+        if replace:
+            for part in directory.glob("part-*.parquet"):
+                part.unlink()
+        self.schema = pyarrow.schema(
+            [(name, self.TYPES[kind]()) for name, kind in columns.items()]
+        )
+        self.path = directory / f"part-{time.strftime('%Y%m%d%H%M%S')}.parquet"
+        self._writer = None
+
+    def write(self, rows: List[dict]):
+        if self._writer is None:
+            self._writer = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+        self._writer.write_table(pyarrow.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def export_sessions(
+    store_kind: str,
+    session_dir: str,
+    db_path: Optional[str],
+    output_dir: Path,
+    prefix: str = "",
+    since: str = "",
+    until: str = "",
+    output_format: str = "",
+    workers: Optional[int] = None,
+    full: bool = False,
+) -> int:
+    """Export every finished session not exported yet, returning how many were written."""
+    output_format = output_format or ("parquet" if pyarrow is not None else "csv")
+    if output_format == "parquet" and pyarrow is None:
+        raise RuntimeError("Parquet output needs pyarrow; use --format csv")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    state_path = output_dir / STATE_FILE
+    exported = set()
+    if full:
+        # the tables are rewritten from scratch; an interrupted full run leaves nothing marked as exported
+        state_path.unlink(missing_ok=True)
+    elif state_path.exists():
+        exported = set(json.loads(state_path.read_text())["exported"])
+
+    store = get_session_store(store_kind, session_dir, db_path)
+    now = time.time()
+    tasks = (
+        (session_id, updated, now)
+        for session_id, updated in store.list_sessions(prefix)
+        if session_id not in exported
+        and (not since or session_id[:10] >= since)
+        and (not until or session_id[:10] <= until)
+    )
+
+    if output_format == "parquet":
+        tables = {
+            name: ParquetTable(output_dir / name, columns, replace=full)
+            for name, columns in TABLES.items()
+        }
+    else:
+        tables = {
+            name: CsvTable(output_dir / f"{name}.csv", columns, replace=full)
+            for name, columns in TABLES.items()
+        }
+    pending = {name: [] for name in TABLES}
+    newly_exported = []
+    try:
+        # spawned rather than forked, so workers don't inherit the parent's open SQLite connections
+        with get_context("spawn").Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(store_kind, session_dir, db_path),
+        ) as pool:
+            for rows in pool.imap_unordered(_export_one, tasks, chunksize=64):
+                if rows is None:
+                    continue
+                newly_exported.append(rows["sessions"][0]["session_id"])
+                for name, table_rows in rows.items():
+                    pending[name].extend(table_rows)
+                    if len(pending[name]) >= BATCH_ROWS:
+                        tables[name].write(pending[name])
+                        pending[name] = []
+        for name, table_rows in pending.items():
+            if table_rows:
+                tables[name].write(table_rows)
+    finally:
+        for table in tables.values():
+            table.close()
+
+    # only recorded once the rows are safely written; an interrupted run is simply redone
+    state_path.write_text(
+        json.dumps({"exported": sorted(exported | set(newly_exported))})
+    )
+    return len(newly_exported)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export saved sessions for analytics")
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument(
+        "--prefix",
+        default="",
+        help="only sessions whose id starts with this, e.g. 2023070",
+    )
+    parser.add_argument("--since", default="", help="first YYYYMMDDHH to include")
+    parser.add_argument("--until", default="", help="last YYYYMMDDHH to include")
+    parser.add_argument("--format", choices=("parquet", "csv"), default="")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="export everything again, replacing what earlier runs wrote",
+    )
+    args = parser.parse_args()
+
+    session_dir = os.environ["SESSION_DIR"]
+    started = time.perf_counter()
+    count = export_sessions(
+        os.environ.get("SESSION_STORE", "file"),
+        session_dir,
+        os.environ.get("SESSION_DB"),
+        args.output_dir,
+        prefix=args.prefix,
+        since=args.since,
+        until=args.until,
+        output_format=args.format,
+        workers=args.workers,
+        full=args.full,
+    )
+    print(
+        f"Exported {count} sessions to {args.output_dir} in {time.perf_counter() - started:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Resized WebP copies of the art in images/, served by streamlit's static file handler.
+# Build them with `python -m utils.images` from src/; the app builds them on first use if they are missing.
+# Files are named after the hash of their source and linked with a ?v= argument, which gets them long-lived
+# cache headers.
+import hashlib
+import json
+from functools import lru_cache
+from html import escape
+from pathlib import Path
+from typing import List, Optional
+
+SRC_DIR = Path(__file__).parent.parent
+IMAGE_DIR = SRC_DIR / "images"
+DERIVATIVES_DIR = SRC_DIR / "static" / "img"
+MANIFEST_PATH = DERIVATIVES_DIR / "manifest.json"
+# the static folder is served by streamlit at this path, relative to the page
+STATIC_URL = "app/static/img"
+
+# header art fills a fifth of the page and the closing art a third; these cover both at 1x and 2x density
+DISPLAY_WIDTHS = (256, 512)
+WEBP_QUALITY = 80
+
+
+def _build_image(source: Path) -> dict:
+    # only needed when the derivatives are (re)built, so kept off the app's import path
+    from PIL import Image
+
+    digest = hashlib.sha256(source.read_bytes()).hexdigest()[:16]
+    with Image.open(source) as img:
+        img = img.convert("RGB")
+        variants = {}
+        for width in DISPLAY_WIDTHS:
+            width = min(width, img.width)
+            name = f"{digest}-{width}.webp"
+            target = DERIVATIVES_DIR / name
+            if not target.exists():
+                height = round(img.height * width / img.width)
+                img.resize((width, height), Image.LANCZOS).save(
+                    target, "WEBP", quality=WEBP_QUALITY, method=6
+                )
+            variants[width] = name
+        return {"hash": digest, "width": img.width, "variants": variants}
+
+
+def build_derivatives() -> dict:
+    DERIVATIVES_DIR.mkdir(parents=True, exist_ok=True)
+    images = {
+        source.name: _build_image(source)
+        for source in sorted(IMAGE_DIR.iterdir())
+        if source.suffix == ".png"
+    }
+    manifest = {"images": images}
+    tmp_path = MANIFEST_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=1))
+    tmp_path.replace(MANIFEST_PATH)
+    return manifest
+
+
+@lru_cache(maxsize=None)
+def load_manifest() -> dict:
+    """Loaded once per process; builds the derivatives if they are missing, falling back to the originals."""
+    try:
+        return json.loads(MANIFEST_PATH.read_text())
+    except FileNotFoundError:
+        pass
+    try:
+        print("Image manifest missing, building image derivatives")
+        return build_derivatives()
+    except OSError as e:
+        print(f"Could not build image derivatives, serving originals: {e}")
+        return {"images": {}}
+
+
+@lru_cache(maxsize=None)
+def available_images() -> List[str]:
+    """Paths (relative to src/, as stored in session state) of the art that can be picked for a reading."""
+    return [
+        str(Path(IMAGE_DIR.name) / name)
+        for name in (
+            load_manifest()["images"] or sorted(x.name for x in IMAGE_DIR.iterdir())
+        )
+        if name != "emily.png"
+    ]
+
+
+@lru_cache(maxsize=None)
+def image_html(image_path: str, sizes: str = "100vw") -> Optional[str]:
+    """An <img> tag for the derivatives of the given source image, or None if it has none."""
+    entry = load_manifest()["images"].get(Path(image_path).name)
+    if entry is None:
+        return None
+    urls = {
+        int(width): f"{STATIC_URL}/{name}?v={entry['hash']}"
+        for width, name in entry["variants"].items()
+    }
+    srcset = ", ".join(f"{url} {width}w" for width, url in sorted(urls.items()))
+    return (
+        f'<img src="{urls[max(urls)]}" srcset="{srcset}" sizes="{escape(sizes)}" '
+        f'style="width: 100%" alt="">'
+    )
+
+
+if __name__ == "__main__":
+    built = build_derivatives()
+    print(f"Built derivatives for {len(built['images'])} images in {DERIVATIVES_DIR}")
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+
+class GenerationJob:
+    """A reply being generated for a session; the page reads its progress while it runs."""
+
+    def __init__(self, session_id: str, job_id: str):
+        self.session_id = session_id
+        self.job_id = job_id
+        self.submitted_at = time.monotonic()
+        self.finished_at = None
+        self.visible = ""
+        self.queue_position = None
+        self.future: Optional[Future] = None
+        # for work that can stop early when its result is no longer wanted
+        self.cancelled = threading.Event()
+        # responses to abandoned requests that arrived after the job recorded them, for the page to count
+        self.late_responses: Deque[dict] = deque()
+
+    def show(self, text: str):
+        self.visible = text
+
+    def set_queue_position(self, position: Optional[int]):
+        self.queue_position = position
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def add_late_response(self, response: dict):
+        self.late_responses.append(response)
+
+    @property
+    def done(self) -> bool:
+        return self.future.done()
+
+
+class JobRunner:
+    """Runs generation jobs on a bounded pool of threads, independently of the script run that started them.
+
+    Jobs are keyed by session and job id, so a page that reloads (or a new script run after a dropped connection)
+    can pick up the job it started. Finished jobs are kept for `keep_finished` seconds for it to collect.
+    """
+
+    def __init__(self, max_workers: int, keep_finished: float = 600.0):
+        self.keep_finished = keep_finished
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="generation")
+        self._jobs: Dict[Tuple[str, str], GenerationJob] = {}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.monotonic()
+        for key, job in list(self._jobs.items()):
+            if (
+                job.finished_at is not None
+                and now - job.finished_at > self.keep_finished
+            ):
+                del self._jobs[key]
+
+    def submit(
+        self, session_id: str, job_id: str, fn: Callable[[GenerationJob], Any]
+    ) -> GenerationJob:
+        """Start `fn(job)` unless the job is already known, and return the job."""
+        with self._lock:
+            self._expire()
+            job = self._jobs.get((session_id, job_id))
+            if job is not None:
+                return job
+            job = GenerationJob(session_id, job_id)
+
+            def run():
+                try:
+                    return fn(job)
+                finally:
+                    job.finished_at = time.monotonic()
+
+            job.future = self._pool.submit(run)
+            self._jobs[(session_id, job_id)] = job
+        return job
+
+    def get(self, session_id: str, job_id: str) -> Optional[GenerationJob]:
+        with self._lock:
+            return self._jobs.get((session_id, job_id))
+
+    def take_late_responses(self, session_id: str) -> List[dict]:
+        """The late responses of the session's jobs not yet taken, except those of jobs that were cancelled."""
+        taken = []
+        with self._lock:
+            for (job_session, _), job in self._jobs.items():
+                if job_session != session_id:
+                    continue
+                while job.late_responses:
+                    response = job.late_responses.popleft()
+                    if not job.cancelled.is_set():
+                        taken.append(response)
+        return taken
+
+    @property
+    def running(self) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.finished_at is None)
@@ -64,3 +64,14 @@ then use the role of Emily to produce a cohesive narrative linking all of the dr
 
 Adhere to these guidelines to ensure an engaging Tarot reading.
 """
+
+SELECTED_CARDS_PREFIX = "The selected cards were"
+
+SUMMARY_SYSTEM_MSG = """\
+You will be given the start of a Tarot reading conversation between Emily, a Tarot reader, and the querent.
+Summarize it in under 200 words for Emily's own reference as the reading continues.
+Keep the querent's name, their situation and concerns, their answers to Emily's questions,
+and the gist of any card interpretations already given. Write plain prose, with no QUESTION or PULL TAROT CARDS lines.
+"""
+
+SUMMARY_PREFIX = "Summary of the reading so far: "
@@ -0,0 +1,191 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._counts[bisect_left(self.buckets, seconds)] += 1
+            self._sum += seconds
+
+    def totals(self) -> Tuple[int, float]:
+        """The number of observations and their sum."""
+        with self._lock:
+            return sum(self._counts), self._sum
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """Every metric in the process, in the Prometheus text exposition format."""
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+def start_metrics_server(port: int):
+    """Serve /metrics on `port` from a daemon thread."""
+    # http.server is only imported when metrics are enabled
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on :{port}/metrics")
+    return server
+
+
+LLM_SECONDS = Histogram(
+    "emilytarot_llm_response_seconds",
+    "Time to produce a reply, including retries, hedges and queueing",
+)
+FIRST_TOKEN_SECONDS = Histogram(
+    "emilytarot_llm_first_token_seconds",
+    "Time from sending a completion request to its first token (its whole response when not streamed)",
+)
+MODERATION_SECONDS = Histogram(
+    "emilytarot_moderation_seconds", "Time taken by a moderation check"
+)
+SESSION_SAVE_SECONDS = Histogram(
+    "emilytarot_session_save_seconds", "Time taken by save_session"
+)
+SESSION_LOAD_SECONDS = Histogram(
+    "emilytarot_session_load_seconds", "Time taken to load a saved session"
+)
+SCRIPT_RUN_SECONDS = Histogram(
+    "emilytarot_script_run_seconds", "Time taken by a full run of the app script"
+)
+COMPLETION_RETRIES = Counter(
+    "emilytarot_completion_retries_total",
+    "Completion requests sent beyond the first for a reply",
+)
+BAD_RESPONSES = Counter(
+    "emilytarot_bad_responses_total", "Completion attempts that were discarded"
+)
+MODERATION_REQUESTS = Counter(
+    "emilytarot_moderation_requests_total", "Moderation API requests sent"
+)
+MODERATION_INPUTS = Counter(
+    "emilytarot_moderation_inputs_total",
+    "User messages sent for moderation; divided by requests, the mean batch size",
+)
+MODERATION_CACHE_HITS = Counter(
+    "emilytarot_moderation_cache_hits_total",
+    "User messages answered from recent moderation verdicts",
+)
+MODEL_FAILOVERS = Counter(
+    "emilytarot_model_failovers_total",
+    "Completion requests routed to a fallback model, by turn type and model",
+)
+FLAGGED_INPUTS = Counter(
+    "emilytarot_flagged_inputs_total", "User messages flagged by moderation"
+)
+TOKENS = Counter("emilytarot_tokens_total", "Tokens used, by model")
+SPECULATIVE_TOKENS = Counter(
+    "emilytarot_speculative_tokens_total",
+    "Tokens of replies generated before Submit, by outcome; generated minus used is wasted",
+)
+SPECULATION_SECONDS_SAVED = Counter(
+    "emilytarot_speculation_seconds_saved_total",
+    "Time replies generated before Submit had already been running when it was pressed",
+)
+MODERATION_SECONDS_SAVED = Counter(
+    "emilytarot_moderation_seconds_saved_total",
+    "Time moderation checks ran alongside generation instead of before it",
+)
@@ -0,0 +1,122 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+
+def _key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class ModerationBatcher:
+    """Moderation checks from every session in the process, sent together.
+
+    Inputs arriving within `window` seconds of the first one waiting (or until `max_batch` are waiting) go out as
+    one request to `request`, which takes a list of inputs and returns whether each was flagged. Identical inputs
+    share one check, and verdicts are cached by a hash of the input for `cache_ttl` seconds. If a batch fails its
+    inputs are checked one at a time, and an input whose own check fails raises to its caller: nothing is let
+    through unchecked.
+    """
+
+    def __init__(
+        self,
+        request: Callable[[List[str]], List[bool]],
+        window: float = 0.05,
+        max_batch: int = 32,
+        cache_size: int = 4096,
+        cache_ttl: float = 600.0,
+        on_cache_hit: Optional[Callable[[], None]] = None,
+    ):
+        self.request = request
+        self.window = window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.on_cache_hit = on_cache_hit
+        self._cache = OrderedDict()
+        # inputs waiting for a verdict, and the batch they are collected into
+        self._waiting: Dict[bytes, Future] = {}
+        self._pending = []
+        self._ready = threading.Condition()
+        self._senders = ThreadPoolExecutor(4, thread_name_prefix="moderation")
+        self._collector = None
+
+    def flagged(self, text: str) -> bool:
+        """Whether moderation flags `text`; blocks until the batch it joins has been checked."""
+        key = _key(text)
+        with self._ready:
+            cached = self._cache.get(key)
+            if cached is not None and cached[1] > time.monotonic():
+                self._cache.move_to_end(key)
+                if self.on_cache_hit is not None:
+                    self.on_cache_hit()
+                return cached[0]
+            future = self._waiting.get(key)
+            if future is None:
+                future = self._waiting[key] = Future()
+                self._pending.append((key, text))
+                self._ready.notify()
+            if self._collector is None:
+                self._collector = threading.Thread(
+                    target=self._collect, name="moderation-batcher", daemon=True
+                )
+                self._collector.start()
+        return future.result()
+
+    def _collect(self):
+        while True:
+            with self._ready:
+                while not self._pending:
+                    self._ready.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+                batch = self._pending[: self.max_batch]
+                del self._pending[: self.max_batch]
+            self._senders.submit(self._send, batch)
+
+    def _check(self, texts: List[str]) -> List[bool]:
+        verdicts = list(self.request(texts))
+        if len(verdicts) != len(texts):
+            raise ValueError(
+                f"{len(verdicts)} moderation results for {len(texts)} inputs"
+            )
+        return verdicts
+
+    def _send(self, batch: list):
+        texts = [text for _, text in batch]
+        try:
+            verdicts = self._check(texts)
+        except Exception as e:
+            if len(texts) == 1:
+                verdicts = [e]
+            else:
+                print(
+                    f"Moderation batch of {len(texts)} failed ({e!r}), checking each input on its own"
+                )
+                verdicts = []
+                for text in texts:
+                    try:
+                        verdicts.extend(self._check([text]))
+                    except Exception as item_error:
+                        verdicts.append(item_error)
+
+        expires = time.monotonic() + self.cache_ttl
+        with self._ready:
+            futures = [self._waiting.pop(key) for key, _ in batch]
+            for (key, _), verdict in zip(batch, verdicts):
+                if not isinstance(verdict, Exception):
+                    self._cache[key] = (verdict, expires)
+                    self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        for future, verdict in zip(futures, verdicts):
+            if isinstance(verdict, Exception):
+                future.set_exception(verdict)
+            else:
+                future.set_result(verdict)
@@ -0,0 +1,60 @@
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})"
+
+
+class StackSampler:
+    """Samples the call stack of one thread from a background thread.
+
+    The result is in the collapsed-stack format (`outer;inner;leaf count` per line) that flamegraph.pl,
+    speedscope and most flamegraph viewers read directly. Nothing runs unless a sampler is started.
+    """
+
+    def __init__(self, thread_id: Optional[int] = None, interval: float = 0.002):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self.started = None
+        self.elapsed = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sample, name="stack-sampler", daemon=True
+        )
+
+    def _sample(self):
+        while not self._stop.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def start(self) -> "StackSampler":
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def write(self, directory: Path, name: str) -> Path:
+        """Write the collapsed stacks to `directory/<unix ms>-<name>.collapsed`."""
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{int(time.time() * 1000)}-{name}.collapsed"
+        path.write_text(
+            "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+        )
+        return path
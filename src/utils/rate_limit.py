@@ -0,0 +1,187 @@
+import sqlite3
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Tuple
+
+
+class Overloaded(RuntimeError):
+    pass
+
+
+class LocalBuckets:
+    """Token buckets refilled continuously at `per_minute`, holding at most one minute's worth."""
+
+    def __init__(self, limits: Dict[str, float]):
+        self.limits = limits
+        now = time.monotonic()
+        self._levels = {name: (float(limit), now) for name, limit in limits.items()}
+        self._lock = threading.Lock()
+
+    def try_take(self, costs: Dict[str, float]) -> float:
+        """Take `costs` from the buckets if they all have enough; otherwise return how long to wait."""
+        with self._lock:
+            now = time.monotonic()
+            levels = {
+                name: min(
+                    self.limits[name], level + (now - updated) * self.limits[name] / 60
+                )
+                for name, (level, updated) in self._levels.items()
+            }
+            wait = _wait_time(self.limits, levels, costs)
+            if wait == 0:
+                for name, cost in costs.items():
+                    levels[name] -= cost
+            self._levels = {name: (level, now) for name, level in levels.items()}
+            return wait
+
+
+class SharedBuckets:
+    """Token buckets kept in a SQLite file, so every process on the host draws from the same budget."""
+
+    def __init__(self, limits: Dict[str, float], db_path, prefix: str = ""):
+        self.limits = limits
+        self.db_path = str(db_path)
+        self.prefix = prefix
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        if not hasattr(self._local, "conn"):
+            self._local.conn = sqlite3.connect(
+                self.db_path, timeout=10, isolation_level=None
+            )
+            self._local.conn.execute("PRAGMA journal_mode=WAL")
+        return self._local.conn
+
+    def try_take(self, costs: Dict[str, float]) -> float:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            stored = {
+                name.removeprefix(self.prefix): (level, updated)
+                for name, level, updated in conn.execute(
+                    "SELECT name, level, updated FROM rate_buckets WHERE name LIKE ?",
+                    (self.prefix + "%",),
+                )
+            }
+            levels = {}
+            for name, limit in self.limits.items():
+                level, updated = stored.get(name, (limit, now))
+                levels[name] = min(limit, level + (now - updated) * limit / 60)
+            wait = _wait_time(self.limits, levels, costs)
+            if wait == 0:
+                for name, cost in costs.items():
+                    levels[name] -= cost
+            conn.executemany(
+                "INSERT OR REPLACE INTO rate_buckets (name, level, updated) VALUES (?, ?, ?)",
+                [(self.prefix + name, level, now) for name, level in levels.items()],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+def _wait_time(
+    limits: Dict[str, float], levels: Dict[str, float], costs: Dict[str, float]
+) -> float:
+    wait = 0.0
+    for name, cost in costs.items():
+        # a request bigger than the bucket only has to wait for a full one
+        needed = min(cost, limits[name]) - levels[name]
+        if needed > 0:
+            wait = max(wait, needed * 60 / limits[name])
+    return wait
+
+
+class RateLimiter:
+    """Admits requests one at a time, in arrival order, as the buckets allow.
+
+    Waiting callers are told their place in line; once `max_queue` callers are waiting, new ones are turned away
+    with Overloaded rather than queued.
+    """
+
+    def __init__(self, buckets, max_queue: int = 50, poll_interval: float = 0.25):
+        self.buckets = buckets
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+        self._queue = deque()
+        self._cond = threading.Condition()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def overloaded(self) -> bool:
+        return self.queue_depth >= self.max_queue
+
+    def acquire(
+        self,
+        costs: Dict[str, float],
+        on_position: Callable[[Optional[int]], None] = None,
+        cancelled: threading.Event = None,
+    ) -> bool:
+        """Block until the request is admitted, or return False if `cancelled` is set while waiting.
+
+        `on_position` is given the caller's place in line while it waits, then None once admitted.
+        """
+        ticket = object()
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                raise Overloaded(f"{len(self._queue)} requests already waiting")
+            self._queue.append(ticket)
+        reported = None
+        try:
+            while True:
+                with self._cond:
+                    position = self._queue.index(ticket) + 1
+                    wait = self.poll_interval
+                    if position == 1:
+                        wait = min(wait, self.buckets.try_take(costs))
+                        if wait == 0:
+                            self._queue.popleft()
+                            self._cond.notify_all()
+                            break
+                if position != reported and on_position is not None:
+                    on_position(position)
+                    reported = position
+                if cancelled is not None and cancelled.is_set():
+                    self._leave(ticket)
+                    return False
+                with self._cond:
+                    self._cond.wait(wait)
+        except BaseException:
+            self._leave(ticket)
+            raise
+        if reported is not None and on_position is not None:
+            on_position(None)
+        return True
+
+    def _leave(self, ticket):
+        with self._cond:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter(
+    name: str,
+    limits: Tuple[Tuple[str, float], ...],
+    max_queue: int,
+    db_path: Optional[str] = None,
+) -> RateLimiter:
+    """The process-wide limiter called `name`; buckets are shared between processes when `db_path` is given."""
+    limits = dict(limits)
+    if db_path:
+        buckets = SharedBuckets(limits, db_path, prefix=f"{name}:")
+    else:
+        buckets = LocalBuckets(limits)
+    return RateLimiter(buckets, max_queue=max_queue)
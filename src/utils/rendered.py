@@ -0,0 +1,122 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from utils.session_schema import dumps
+
+# bump when what a frozen reading holds (or how it is shown) changes; older files are then rebuilt
+RENDER_VERSION = 1
+
+# a piece of the page: ["markdown", text], ["html", markup] or ["image", path]
+Block = List[str]
+
+
+@dataclass
+class FrozenReading:
+    """Everything needed to show a finished reading, worked out once."""
+
+    session_id: str
+    header: List[Block]
+    feature: Block
+    transcript: List[Block]
+    closing: Block
+    version: int = RENDER_VERSION
+
+
+class RenderCache:
+    """Frozen readings kept in memory (the `max_entries` most recently shown) and as `<session_id>.json` files.
+
+    Finished readings never change, so an entry is only replaced when RENDER_VERSION moves on. Sessions that
+    couldn't be frozen (not finished, or not found) are remembered as such for `retry_after` seconds.
+    """
+
+    def __init__(self, directory, max_entries: int = 256, retry_after: float = 30.0):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        self.retry_after = retry_after
+        self._memory = OrderedDict()
+        self._unfrozen: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, session_id: str) -> Path:
+        return self.directory / (session_id + ".json")
+
+    def _remember(self, frozen: FrozenReading):
+        with self._lock:
+            self._memory[frozen.session_id] = frozen
+            self._memory.move_to_end(frozen.session_id)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _read(self, session_id: str) -> Optional[FrozenReading]:
+        try:
+            stored = json.loads(self._path(session_id).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        if stored.get("version") != RENDER_VERSION:
+            return None
+        return FrozenReading(**stored)
+
+    def _write(self, frozen: FrozenReading):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(dumps(asdict(frozen)))
+            os.replace(tmp_path, self._path(frozen.session_id))
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    def get(
+        self,
+        session_id: str,
+        freeze: Callable[[], Optional[FrozenReading]],
+        retry: bool = False,
+    ) -> Optional[FrozenReading]:
+        """The frozen reading for `session_id`, made with `freeze()` if it isn't cached yet.
+
+        `freeze` returns None for readings that can't be frozen (unknown, or not finished); only that is cached
+        then, unless `retry` is set (e.g. by the page that just finished the reading).
+        """
+        now = time.monotonic()
+        with self._lock:
+            frozen = self._memory.get(session_id)
+            if frozen is not None:
+                self._memory.move_to_end(session_id)
+                return frozen
+            if not retry and self._unfrozen.get(session_id, 0) > now:
+                return None
+        frozen = self._read(session_id)
+        if frozen is None:
+            frozen = freeze()
+            if frozen is None:
+                with self._lock:
+                    for key, until in list(self._unfrozen.items()):
+                        if until <= now:
+                            del self._unfrozen[key]
+                    self._unfrozen[session_id] = now + self.retry_after
+                return None
+            self._write(frozen)
+        self._remember(frozen)
+        return frozen
+
+    def expire(self, before: str) -> int:
+        """Drop readings whose (date_id) session id sorts before `before`, as session retention does."""
+        removed = 0
+        with self._lock:
+            for session_id in [s for s in self._memory if s[: len(before)] < before]:
+                del self._memory[session_id]
+        if not self.directory.exists():
+            return 0
+        for path in self.directory.glob("*.json"):
+            if path.stem[: len(before)] < before:
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
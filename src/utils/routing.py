@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Collection, Dict, List, Optional, Tuple
+
+# the route used for turn types the config doesn't name
+DEFAULT_ROUTE = "default"
+
+
+@dataclass
+class Route:
+    # in order of preference; later models are used while earlier ones are degraded
+    models: List[str]
+    max_tokens: Optional[int] = None
+    # a model whose recent 95th percentile latency goes over this many seconds counts as degraded
+    max_latency: Optional[float] = None
+
+
+def load_routes(path) -> Dict[str, Route]:
+    """Read `{turn type: {"models": [...], "max_tokens": n, "max_latency": s}}` from a JSON file."""
+    config = json.loads(Path(path).read_text())
+    routes = {}
+    for turn_type, route in config.items():
+        models = route.get("models")
+        if not models or not all(isinstance(m, str) for m in models):
+            raise ValueError(f"Route {turn_type!r} in {path} needs a list of models")
+        routes[turn_type] = Route(
+            models=models,
+            max_tokens=route.get("max_tokens"),
+            max_latency=route.get("max_latency"),
+        )
+    if DEFAULT_ROUTE not in routes:
+        raise ValueError(f"{path} needs a {DEFAULT_ROUTE!r} route")
+    return routes
+
+
+class ModelHealth:
+    """Rolling record of one model's recent requests: whether each succeeded, and how long the good ones took."""
+
+    def __init__(self, window: int = 50):
+        self.outcomes = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+        self.degraded_until = 0.0
+
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def latency(self, q: float = 0.95) -> float:
+        samples = sorted(self.latencies)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class ModelRouter:
+    """Chooses the model (and max_tokens) for each request by turn type, moving off models that degrade.
+
+    A model is degraded once at least `min_samples` recent requests show an error rate of `max_error_rate` or
+    more, or a latency over its route's `max_latency`. It is then passed over for `cooldown` seconds, after which
+    its record starts afresh. If every model of a route is degraded the one recovering soonest is used.
+    """
+
+    def __init__(
+        self,
+        routes: Dict[str, Route],
+        max_error_rate: float = 0.5,
+        min_samples: int = 10,
+        cooldown: float = 60.0,
+        window: int = 50,
+        on_failover: Optional[Callable[[str, str], None]] = None,
+    ):
+        self.routes = routes
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self.on_failover = on_failover
+        self._window = window
+        self._health: Dict[str, ModelHealth] = {}
+        self._lock = threading.Lock()
+
+    def _model_health(self, model: str) -> ModelHealth:
+        if model not in self._health:
+            self._health[model] = ModelHealth(self._window)
+        return self._health[model]
+
+    def choose(
+        self, turn_type: str, exclude: Collection[str] = ()
+    ) -> Tuple[str, Optional[int]]:
+        """The model and max_tokens to use for the next request of `turn_type`.
+
+        Models in `exclude` (e.g. ones that already failed this reply) are only used if no other healthy one is left.
+        """
+        route = self.routes.get(turn_type) or self.routes[DEFAULT_ROUTE]
+        now = time.monotonic()
+        with self._lock:
+            healths = [self._model_health(model) for model in route.models]
+            for model, health in zip(route.models, healths):
+                if health.degraded_until and health.degraded_until <= now:
+                    # back on probation with a clean record
+                    health.degraded_until = 0.0
+                    health.outcomes.clear()
+                    health.latencies.clear()
+            available = [
+                model
+                for model, health in zip(route.models, healths)
+                if not health.degraded_until
+            ]
+            preferred = [model for model in available if model not in exclude]
+            if preferred or available:
+                model = (preferred or available)[0]
+            else:
+                model = min(route.models, key=lambda m: self._health[m].degraded_until)
+        if model != route.models[0] and self.on_failover is not None:
+            self.on_failover(turn_type, model)
+        return model, route.max_tokens
+
+    def record(
+        self,
+        turn_type: str,
+        model: str,
+        ok: bool,
+        latency: Optional[float] = None,
+    ):
+        """Record how a request to `model` went; `latency` is for requests that produced a response."""
+        route = self.routes.get(turn_type) or self.routes[DEFAULT_ROUTE]
+        with self._lock:
+            health = self._model_health(model)
+            health.outcomes.append(ok)
+            if latency is not None:
+                health.latencies.append(latency)
+            if health.degraded_until or len(health.outcomes) < self.min_samples:
+                return
+            reason = None
+            if health.error_rate() >= self.max_error_rate:
+                reason = f"{health.error_rate():.0%} of recent requests failed"
+            elif (
+                route.max_latency is not None
+                and len(health.latencies) >= self.min_samples
+                and health.latency() > route.max_latency
+            ):
+                reason = f"95th percentile latency is {health.latency():.2f}s"
+            if reason is not None:
+                health.degraded_until = time.monotonic() + self.cooldown
+        if reason is not None:
+            print(f"Model {model} is degraded ({reason}), routing around it")
@@ -0,0 +1,115 @@
+import json
+from typing import List, Optional
+
+from utils.deck import card_id, to_mask
+
+# bump when the stored form changes, and teach `upgrade` to read the previous one
+SCHEMA_VERSION = 2
+
+# the fields a saved reading keeps: name -> (type, default); fields defaulting to None are left out when unset
+FIELDS = {
+    "session_id": (str, ""),
+    "reading_in_progress": (bool, True),
+    "started_chat": (bool, False),
+    "card_draw_type": (str, ""),
+    "chat_history": (list, list),
+    "history_summary": (dict, None),
+    "drawn_cards": (int, 0),
+    "chosen_virtual_cards": (list, list),
+    "shuffle_seed": (str, None),
+    "deck_seed": (str, None),
+    "deck_position": (int, 0),
+    "total_tokens_used": (int, 0),
+    "discarded_responses": (int, 0),
+    "discarded_tokens": (int, 0),
+    "pending_job": (str, None),
+    "flagged_input": (bool, None),
+    # the art picked when the reading started, so reloads and shared links show the same pictures
+    "header_images": (list, None),
+    "emily_image": (str, None),
+    "closing_image": (str, None),
+}
+
+_ROLE_CODES = {"system": "s", "user": "u", "assistant": "a"}
+_ROLES = {code: role for role, code in _ROLE_CODES.items()}
+
+
+def dumps(value) -> str:
+    return json.dumps(value, separators=(",", ":"))
+
+
+def persisted(state: dict) -> dict:
+    """The schema fields present in `state`, e.g. the page's session state."""
+    return {name: state[name] for name in FIELDS if name in state}
+
+
+def apply_journal(data: dict, records: List[dict]) -> dict:
+    """Replay journal records onto a session snapshot.
+
+    Records are idempotent: list growth is stored with its start index, so replaying a record twice is harmless.
+    """
+    for record in records:
+        data.update(record.get("set", {}))
+        for key in record.get("unset", []):
+            data.pop(key, None)
+        for key, (start, items) in record.get("extend", {}).items():
+            data[key] = data.get(key, [])[:start] + items
+    return data
+
+
+def upgrade(data: dict) -> dict:
+    """Type and trim session data to the schema, converting what older versions stored along the way."""
+    if "bad_responses" in data:
+        # version 1 kept every raw discarded response in the session; only their count and cost stay
+        bad_responses = data.pop("bad_responses")
+        data["discarded_responses"] = len(bad_responses)
+        data["discarded_tokens"] = sum(
+            r["usage"]["total_tokens"] for r in bad_responses
+        )
+    if "all_chosen_cards" in data:
+        # sessions saved before cards were stored by id
+        data["drawn_cards"] = to_mask(
+            card_id(name) for name in data["all_chosen_cards"]
+        )
+        data["chosen_virtual_cards"] = [
+            card_id(name) for name in data.get("chosen_virtual_cards", [])
+        ]
+
+    typed = {}
+    for name, (kind, default) in FIELDS.items():
+        value = data.get(name)
+        if value is None:
+            if default is None:
+                continue
+            value = default() if callable(default) else default
+        typed[name] = value if type(value) is kind else kind(value)
+    return typed
+
+
+def encode(data: dict) -> str:
+    """The stored form of a session: minified JSON of its schema fields, messages as `[role code, content]`."""
+    stored = {"v": SCHEMA_VERSION}
+    for name, value in persisted(data).items():
+        if name == "chat_history":
+            value = [[_ROLE_CODES[m["role"]], m["content"]] for m in value]
+        stored[name] = value
+    return dumps(stored)
+
+
+def decode(stored: dict, records: Optional[List[dict]] = None) -> dict:
+    """Session data from its stored form and any journal records written after it."""
+    if stored.get("v") == SCHEMA_VERSION:
+        stored = dict(stored)
+        del stored["v"]
+        stored["chat_history"] = [
+            {"role": _ROLES[code], "content": content}
+            for code, content in stored.get("chat_history", [])
+        ]
+    return upgrade(apply_journal(stored, records or []))
+
+
+def legacy_bad_responses(stored: dict, records: Optional[List[dict]] = None) -> list:
+    """The raw discarded responses a version 1 session carries, which newer versions log elsewhere."""
+    if "v" in stored:
+        return []
+    return apply_journal(dict(stored), records or []).get("bad_responses", [])
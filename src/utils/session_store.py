@@ -0,0 +1,595 @@
+import fcntl
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from queue import Empty, LifoQueue
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from utils.diagnostics import DiagnosticsLog
+from utils.rendered import RenderCache
+from utils.session_schema import decode, dumps, encode, legacy_bad_responses
+
+
+class SessionStore(ABC):
+    @abstractmethod
+    def _load_stored(self, session_id: str) -> Optional[Tuple[dict, List[dict]]]:
+        """The stored snapshot and its journal records as written, or None if there is no such session."""
+
+    def load(self, session_id: str) -> Optional[dict]:
+        """Return the saved session data with its journal applied, or None if there is no such session."""
+        stored = self._load_stored(session_id)
+        if stored is None:
+            return None
+        return decode(*stored)
+
+    @abstractmethod
+    def save(self, session_id: str, data: dict):
+        """Write a full snapshot of the session, replacing any journal."""
+
+    @abstractmethod
+    def append(self, session_id: str, records: List[dict]):
+        """Append journal records to an existing snapshot."""
+
+    @abstractmethod
+    def list_sessions(self, prefix: str = "") -> Iterator[Tuple[str, float]]:
+        """Yield `(session_id, last updated timestamp)` for every session whose id starts with `prefix`."""
+
+    @abstractmethod
+    def expire(self, before: str) -> int:
+        """Delete every session whose id (a date_id) sorts before the `before` prefix; returns how many."""
+
+    def compact(self, session_id: str, final: bool = False):
+        """Fold the journal into the snapshot; `final` is set once the reading is over."""
+        data = self.load(session_id)
+        if data is not None:
+            self.save(session_id, data)
+
+    def upgrade(self, session_id: str, diagnostics: DiagnosticsLog) -> bool:
+        """Rewrite a session saved by an older version in the current schema, moving its raw discarded responses
+        to `diagnostics`; returns whether it needed it."""
+        stored = self._load_stored(session_id)
+        if stored is None or stored[0].get("v") is not None:
+            return False
+        diagnostics.append(session_id, legacy_bad_responses(*stored))
+        self.save(session_id, decode(*stored))
+        return True
+
+
+class FileSessionStore(SessionStore):
+    """One `<session_id>.json` snapshot per session, replaced atomically, plus a `<session_id>.journal` of JSON lines.
+
+    With `sharded`, new snapshots are written to `YYYY/MM/DD/` subdirectories taken from the session id (ids are
+    date_ids); with `compress`, finished readings are stored as `<session_id>.json.gz`. Sessions are found in
+    either layout and either format, so flat files stay readable until `migrate` moves them.
+    """
+
+    def __init__(self, directory, sharded: bool = False, compress: bool = False):
+        self.directory = Path(directory)
+        self.sharded = sharded
+        self.compress = compress
+        self._lock_path = self.directory / ".lock"
+
+    def shard_dir(self, session_id: str) -> Path:
+        if len(session_id) < 8 or not session_id[:8].isdigit():
+            return self.directory
+        return self.directory / session_id[:4] / session_id[4:6] / session_id[6:8]
+
+    def _home(self, session_id: str) -> Path:
+        """The directory new writes of the session go to."""
+        return self.shard_dir(session_id) if self.sharded else self.directory
+
+    def _locate(self, session_id: str) -> Path:
+        """The directory the session is currently stored in, or its home if it isn't stored yet."""
+        home = self._home(session_id)
+        for directory in dict.fromkeys(
+            (home, self.shard_dir(session_id), self.directory)
+        ):
+            for suffix in (".json", ".json.gz"):
+                if (directory / (session_id + suffix)).exists():
+                    return directory
+        return home
+
+    @contextmanager
+    def _locked(self):
+        # serializes writers across processes sharing the directory
+        with open(self._lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_stored(self, session_id: str) -> Optional[Tuple[dict, List[dict]]]:
+        directory = self._locate(session_id)
+        try:
+            data = json.loads((directory / (session_id + ".json")).read_text())
+        except FileNotFoundError:
+            try:
+                with gzip.open(directory / (session_id + ".json.gz"), "rt") as f:
+                    data = json.load(f)
+            except (FileNotFoundError, OSError, ValueError):
+                return None
+        except ValueError:
+            return None
+        try:
+            journal = (directory / (session_id + ".journal")).read_text()
+        except FileNotFoundError:
+            return data, []
+        records = []
+        for line in journal.splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # a torn final line from an interrupted append
+                break
+        return data, records
+
+    def _remove_copies(self, session_id: str, keep: Path):
+        for directory in dict.fromkeys((self.shard_dir(session_id), self.directory)):
+            for suffix in (".json", ".json.gz", ".journal"):
+                path = directory / (session_id + suffix)
+                if path != keep:
+                    path.unlink(missing_ok=True)
+
+    @contextmanager
+    def _snapshot(self, session_id: str, data: dict, compress: bool):
+        """Write the snapshot to a temporary file and yield it with the path it should replace; it is removed
+        again unless the caller moved it there."""
+        home = self._home(session_id)
+        home.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=home, suffix=".tmp")
+        try:
+            if compress:
+                target = home / (session_id + ".json.gz")
+                with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt") as f:
+                    f.write(encode(data))
+            else:
+                target = home / (session_id + ".json")
+                with os.fdopen(fd, "w") as f:
+                    f.write(encode(data))
+            yield tmp_path, target
+        finally:
+            Path(tmp_path).unlink(missing_ok=True)
+
+    def _replace(self, session_id: str, tmp_path: str, target: Path):
+        # callers hold the lock
+        os.replace(tmp_path, target)
+        self._remove_copies(session_id, keep=target)
+
+    def save(self, session_id: str, data: dict, compress: bool = False):
+        with self._snapshot(session_id, data, compress) as (tmp_path, target):
+            with self._locked():
+                self._replace(session_id, tmp_path, target)
+
+    def append(self, session_id: str, records: List[dict]):
+        lines = "".join(dumps(record) + "\n" for record in records)
+        with self._locked():
+            journal = self._locate(session_id) / (session_id + ".journal")
+            with open(journal, "a") as f:
+                f.write(lines)
+
+    def compact(self, session_id: str, final: bool = False):
+        compress = final and self.compress
+        # held from the read to the journal's removal, so no record appended in between is lost
+        with self._locked():
+            directory = self._locate(session_id)
+            if not compress and not (directory / (session_id + ".journal")).exists():
+                return
+            stored = self._load_stored(session_id)
+            if stored is None:
+                return
+            snapshot = self._snapshot(session_id, decode(*stored), compress)
+            with snapshot as (tmp_path, target):
+                self._replace(session_id, tmp_path, target)
+
+    def upgrade(self, session_id: str, diagnostics: DiagnosticsLog) -> bool:
+        compressed = (self._locate(session_id) / (session_id + ".json.gz")).exists()
+        if not super().upgrade(session_id, diagnostics):
+            return False
+        if compressed:
+            # finished readings stay compressed
+            self.save(session_id, self.load(session_id), compress=True)
+        return True
+
+    def _entries(self, directory: Path, prefix: str, depth: int = 0):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir() and entry.name.isdigit():
+                    # YYYY, then MM, then DD; only descend where the prefix can still match
+                    key = str(Path(entry.path).relative_to(self.directory)).replace(
+                        os.sep, ""
+                    )
+                    if depth < 3 and key[: len(prefix)] == prefix[: len(key)]:
+                        yield from self._entries(Path(entry.path), prefix, depth + 1)
+                elif entry.name.startswith(prefix):
+                    yield entry
+
+    def list_sessions(self, prefix: str = "") -> Iterator[Tuple[str, float]]:
+        updated = {}
+        for entry in self._entries(self.directory, prefix):
+            for suffix in (".json", ".json.gz", ".journal"):
+                if entry.name.endswith(suffix):
+                    session_id = entry.name.removesuffix(suffix)
+                    updated[session_id] = max(
+                        updated.get(session_id, 0), entry.stat().st_mtime
+                    )
+                    break
+        yield from updated.items()
+
+    def expire(self, before: str) -> int:
+        removed = 0
+        for session_id, _ in list(self.list_sessions()):
+            if session_id[: len(before)] < before:
+                with self._locked():
+                    self._remove_copies(session_id, keep=None)
+                removed += 1
+        # drop the day, month and year directories that are now empty
+        for root, _, _ in os.walk(self.directory, topdown=False):
+            if (
+                root != str(self.directory)
+                and Path(root).name.isdigit()
+                and not os.listdir(root)
+            ):
+                os.rmdir(root)
+        return removed
+
+    def migrate(self) -> int:
+        """Move every flat session into its shard; returns how many were moved."""
+        sessions = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                for suffix in (".json", ".json.gz", ".journal"):
+                    if entry.is_file() and entry.name.endswith(suffix):
+                        sessions.setdefault(entry.name.removesuffix(suffix), [])
+                        sessions[entry.name.removesuffix(suffix)].append(entry.name)
+                        break
+        moved = 0
+        for session_id, names in sessions.items():
+            shard = self.shard_dir(session_id)
+            if shard == self.directory:
+                continue
+            shard.mkdir(parents=True, exist_ok=True)
+            # the snapshot and its journal move together, so appends never land in the wrong place
+            with self._locked():
+                if any(
+                    (shard / (session_id + suffix)).exists()
+                    for suffix in (".json", ".json.gz")
+                ):
+                    # already rewritten in the new layout, which is newer
+                    for name in names:
+                        (self.directory / name).unlink(missing_ok=True)
+                    continue
+                for name in names:
+                    if (self.directory / name).exists():
+                        os.replace(self.directory / name, shard / name)
+            moved += 1
+        return moved
+
+
+class SqliteSessionStore(SessionStore):
+    """Sessions stored as rows in a WAL-mode SQLite database.
+
+    Any number of processes on the same host can share the database file; each process keeps a small pool of
+    connections and every save is a single atomic upsert.
+    """
+
+    def __init__(self, db_path, pool_size: int = 4):
+        self.db_path = str(db_path)
+        self._pool = LifoQueue(maxsize=pool_size)
+        with self._connection() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    date_id TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS sessions_date_id ON sessions (date_id);
+                CREATE TABLE IF NOT EXISTS session_journal (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    record TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS session_journal_session_id ON session_journal (session_id);
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        try:
+            conn = self._pool.get_nowait()
+        except Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except Exception:
+                conn.close()
+
+    def _load_stored(self, session_id: str) -> Optional[Tuple[dict, List[dict]]]:
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT data FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            records = conn.execute(
+                "SELECT record FROM session_journal WHERE session_id = ? ORDER BY seq",
+                (session_id,),
+            ).fetchall()
+        return json.loads(row[0]), [json.loads(r[0]) for r in records]
+
+    def save(self, session_id: str, data: dict):
+        with self._connection() as conn, conn:
+            conn.execute(
+                "DELETE FROM session_journal WHERE session_id = ?", (session_id,)
+            )
+            self._upsert(conn, session_id, data)
+
+    @staticmethod
+    def _upsert(conn: sqlite3.Connection, session_id: str, data: dict):
+        conn.execute(
+            """
+            INSERT INTO sessions (session_id, date_id, updated, data) VALUES (?, ?, ?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET updated = excluded.updated, data = excluded.data
+            """,
+            # session ids are date_ids, which begin with their YYYYMMDDHH creation time
+            (session_id, session_id[:10], time.time(), encode(data)),
+        )
+
+    def append(self, session_id: str, records: List[dict]):
+        with self._connection() as conn, conn:
+            conn.executemany(
+                "INSERT INTO session_journal (session_id, record) VALUES (?, ?)",
+                [(session_id, dumps(record)) for record in records],
+            )
+
+    def compact(self, session_id: str, final: bool = False):
+        with self._connection() as conn:
+            # one write transaction from the read to the delete, which only takes the records that were read
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT data FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                records = conn.execute(
+                    "SELECT seq, record FROM session_journal WHERE session_id = ? ORDER BY seq",
+                    (session_id,),
+                ).fetchall()
+                if row is not None and records:
+                    data = decode(
+                        json.loads(row[0]), [json.loads(r) for _, r in records]
+                    )
+                    self._upsert(conn, session_id, data)
+                    conn.execute(
+                        "DELETE FROM session_journal WHERE session_id = ? AND seq <= ?",
+                        (session_id, records[-1][0]),
+                    )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def list_sessions(self, prefix: str = "") -> Iterator[Tuple[str, float]]:
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT session_id, updated FROM sessions WHERE session_id >= ? ORDER BY session_id",
+                (prefix,),
+            )
+            for session_id, updated in rows:
+                if not session_id.startswith(prefix):
+                    break
+                yield session_id, updated
+
+    def expire(self, before: str) -> int:
+        with self._connection() as conn, conn:
+            conn.execute(
+                "DELETE FROM session_journal WHERE session_id IN "
+                "(SELECT session_id FROM sessions WHERE substr(date_id, 1, ?) < ?)",
+                (len(before), before),
+            )
+            return conn.execute(
+                "DELETE FROM sessions WHERE substr(date_id, 1, ?) < ?",
+                (len(before), before),
+            ).rowcount
+
+
+def _encode(data: dict) -> dict:
+    return {
+        k: [json.dumps(x) for x in v] if isinstance(v, list) else json.dumps(v)
+        for k, v in data.items()
+    }
+
+
+class SessionWriter:
+    """Writes only what changed since the last save of each session.
+
+    The encoding of what was last written is kept per session; unchanged state is skipped, list fields that only
+    grew (chat turns, drawn cards) are appended to the journal, and the journal is folded back into the snapshot
+    once it gets long or the caller asks for it.
+    """
+
+    def __init__(
+        self, store: SessionStore, max_sessions: int = 1000, max_journal: int = 20
+    ):
+        self.store = store
+        self.max_sessions = max_sessions
+        self.max_journal = max_journal
+        self._written = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, session_id: str, encoded: dict, journal_len: int):
+        with self._lock:
+            self._written[session_id] = (encoded, journal_len)
+            self._written.move_to_end(session_id)
+            while len(self._written) > self.max_sessions:
+                self._written.popitem(last=False)
+
+    def track(self, session_id: str, data: dict, appended: bool = False):
+        """Record `data` as already persisted, e.g. right after loading it.
+
+        `appended` says it got there through a journal record written elsewhere, which counts towards compaction.
+        """
+        journal_len = 0
+        if appended:
+            with self._lock:
+                journal_len = self._written.get(session_id, (None, 0))[1] + 1
+        self._remember(session_id, _encode(data), journal_len)
+
+    def save(self, session_id: str, data: dict, compact: bool = False) -> bool:
+        """Persist the session if it changed; returns whether anything was written."""
+        encoded = _encode(data)
+        with self._lock:
+            previous = self._written.get(session_id)
+
+        if previous is None:
+            self.store.save(session_id, data)
+            self._remember(session_id, encoded, 0)
+            return True
+
+        written, journal_len = previous
+        record = {}
+        for key, value in encoded.items():
+            old_value = written.get(key)
+            if old_value == value:
+                continue
+            if (
+                isinstance(value, list)
+                and isinstance(old_value, list)
+                and value[: len(old_value)] == old_value
+            ):
+                start = len(old_value)
+                record.setdefault("extend", {})[key] = [start, data[key][start:]]
+            else:
+                record.setdefault("set", {})[key] = data[key]
+        removed = [key for key in written if key not in encoded]
+        if removed:
+            record["unset"] = removed
+
+        if record:
+            self.store.append(session_id, [record])
+            journal_len += 1
+        if journal_len and (compact or journal_len >= self.max_journal):
+            self.store.compact(session_id, final=compact)
+            journal_len = 0
+        self._remember(session_id, encoded, journal_len)
+        return bool(record)
+
+
+@lru_cache(maxsize=None)
+def get_session_writer(store: SessionStore) -> SessionWriter:
+    return SessionWriter(store)
+
+
+@lru_cache(maxsize=None)
+def get_session_store(
+    kind: str,
+    session_dir: str,
+    db_path: Optional[str] = None,
+    sharded: bool = False,
+    compress: bool = False,
+) -> SessionStore:
+    """Return the process-wide store of the given kind ("file" or "sqlite")."""
+    if kind == "file":
+        return FileSessionStore(session_dir, sharded=sharded, compress=compress)
+    if kind == "sqlite":
+        return SqliteSessionStore(db_path or Path(session_dir) / "sessions.sqlite3")
+    raise ValueError(f"Unknown session store {kind!r}")
+
+
+def retention_cutoff(days: int, now: Optional[float] = None) -> str:
+    """The date_id prefix (YYYYMMDDHH) before which sessions are older than `days`."""
+    return time.strftime("%Y%m%d%H", time.gmtime((now or time.time()) - days * 86400))
+
+
+def start_retention_sweeper(
+    store: SessionStore, days: int, interval: float = 3600, derived: Sequence = ()
+) -> threading.Thread:
+    """Delete sessions older than `days` now and every `interval` seconds, from a daemon thread.
+
+    `derived` are other stores keyed by session id (anything with `expire(before)`), swept along with the sessions.
+    """
+
+    def sweep():
+        while True:
+            try:
+                cutoff = retention_cutoff(days)
+                removed = store.expire(cutoff)
+                for other in derived:
+                    other.expire(cutoff)
+                if removed:
+                    print(f"Removed {removed} sessions older than {days} days")
+            except Exception as e:
+                print(f"Session sweep failed: {e!r}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=sweep, name="session-sweeper", daemon=True)
+    thread.start()
+    return thread
+
+
+USAGE = """maintenance from src/, with the app's SESSION_* settings:
+  python -m utils.session_store sweep DAYS    delete sessions older than DAYS
+  python -m utils.session_store migrate       move flat session files into YYYY/MM/DD shards
+  python -m utils.session_store upgrade       rewrite sessions saved by older versions in the current schema"""
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2 or (sys.argv[1] == "sweep" and len(sys.argv) < 3):
+        sys.exit(USAGE)
+    store = get_session_store(
+        os.environ.get("SESSION_STORE", "file"),
+        os.environ["SESSION_DIR"],
+        os.environ.get("SESSION_DB"),
+        # the layout sessions are rewritten in, as the app writes them; migrate is what moves them to shards
+        sharded=sys.argv[1] == "migrate"
+        or os.environ.get("SESSION_LAYOUT", "flat") == "sharded",
+        compress=os.environ.get("SESSION_COMPRESS", "0") == "1",
+    )
+    if sys.argv[1] == "sweep":
+        days = int(sys.argv[2])
+        cutoff = retention_cutoff(days)
+        print(f"Removed {store.expire(cutoff)} sessions older than {days} days")
+        RenderCache(
+            os.environ.get(
+                "RENDER_CACHE_DIR", Path(os.environ["SESSION_DIR"]) / "rendered"
+            )
+        ).expire(cutoff)
+    elif sys.argv[1] == "migrate":
+        if not isinstance(store, FileSessionStore):
+            sys.exit("Only the file store has a layout to migrate")
+        print(f"Moved {store.migrate()} sessions into dated subdirectories")
+    elif sys.argv[1] == "upgrade":
+        diagnostics = DiagnosticsLog(
+            os.environ.get(
+                "DIAGNOSTICS_DIR", Path(os.environ["SESSION_DIR"]) / "diagnostics"
+            ),
+            "bad_responses",
+        )
+        upgraded = sum(
+            store.upgrade(session_id, diagnostics)
+            for session_id, _ in list(store.list_sessions())
+        )
+        print(f"Upgraded {upgraded} sessions to the current schema")
+    else:
+        sys.exit(f"Unknown command {sys.argv[1]!r}\n\n{USAGE}")
@@ -0,0 +1,60 @@
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+# the app imports this before its other modules, so the gap to its first script run is their import time
+IMPORTED_AT = time.perf_counter()
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE") == "1"
+
+_first_render_lock = threading.Lock()
+_first_render_reported = False
+_openai_lock = threading.Lock()
+
+
+def process_uptime() -> Optional[float]:
+    """Seconds since this process started, where /proc makes that available."""
+    try:
+        with open("/proc/self/stat") as f:
+            # starttime is the 22nd field; the command name before it may contain spaces
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def report_first_render(script_started: float):
+    """With STARTUP_PROFILE=1, print how long the first page render in this process took to arrive."""
+    global _first_render_reported
+    if not STARTUP_PROFILE:
+        return
+    with _first_render_lock:
+        if _first_render_reported:
+            return
+        _first_render_reported = True
+    uptime = process_uptime()
+    uptime = f"{uptime:.2f}s" if uptime is not None else "unknown"
+    print(
+        f"Startup profile: first render {uptime} after process start; "
+        f"app imports took {script_started - IMPORTED_AT:.3f}s, "
+        f"the script run {time.perf_counter() - script_started:.3f}s"
+    )
+
+
+def openai_module():
+    """The openai package, imported the first time it is needed; it is the slowest import the app has."""
+    with _openai_lock:
+        if "openai" not in sys.modules:
+            started = time.perf_counter()
+            import openai
+
+            if STARTUP_PROFILE:
+                print(
+                    f"Startup profile: importing openai took {time.perf_counter() - started:.3f}s"
+                )
+    import openai
+
+    return openai
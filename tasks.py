@@ -7,6 +7,7 @@ from invoke import task, Context
 class Paths:
     here = Path(__file__).parent
     repo_root = here
+    src = repo_root / "src"
 
     @staticmethod
     @contextmanager
@@ -19,3 +20,74 @@ class Paths:
 def compile_requirements(c):
     with Paths.cd(c, Paths.repo_root):
         c.run("pip-compile --resolver=backtracking -v -o requirements.txt")
+
+
+@task
+def export_sessions(
+    c, output="exports", prefix="", since="", until="", format="", workers=0, full=False
+):
+    """Export finished sessions from SESSION_DIR to Parquet/CSV tables, skipping ones already exported."""
+    args = [str(Path(output).resolve())]
+    for name, value in (("prefix", prefix), ("since", since), ("until", until)):
+        if value:
+            args.append(f"--{name} {value}")
+    if format:
+        args.append(f"--format {format}")
+    if workers:
+        args.append(f"--workers {workers}")
+    if full:
+        args.append("--full")
+    with Paths.cd(c, Paths.src):
+        c.run("python -m utils.export_sessions " + " ".join(args))
+
+
+@task
+def sweep_sessions(c, days):
+    """Delete sessions older than `days` from the store configured by the SESSION_* variables (e.g. from cron)."""
+    with Paths.cd(c, Paths.src):
+        c.run(f"python -m utils.session_store sweep {int(days)}")
+
+
+@task
+def migrate_sessions(c):
+    """Move flat session files in SESSION_DIR into YYYY/MM/DD subdirectories."""
+    with Paths.cd(c, Paths.src):
+        c.run("python -m utils.session_store migrate")
+
+
+@task
+def upgrade_sessions(c):
+    """Rewrite sessions saved by older versions of the app in the current session schema."""
+    with Paths.cd(c, Paths.src):
+        c.run("python -m utils.session_store upgrade")
+
+
+@task
+def build_images(c):
+    with Paths.cd(c, Paths.src):
+        c.run("python -m utils.images")
+
+
+@task
+def bench(c, concurrency="1,2,4,8", readings=2, latency=0.5, output="bench.json"):
+    with Paths.cd(c, Paths.repo_root):
+        c.run(
+            f"python bench/run_bench.py --concurrency {concurrency} --readings {readings} "
+            f"--latency {latency} --output {output}"
+        )
+
+
+@task
+def simulate_draws(c, spreads=1_000_000, cards=3, drawn=0, seed_prefix="", output=""):
+    """Draw many seeded spreads at once, check them against the app's draw() and for uniformity, and time it."""
+    args = [
+        f"--spreads {int(spreads)}",
+        f"--cards {int(cards)}",
+        f"--drawn {int(drawn)}",
+    ]
+    if seed_prefix:
+        args.append(f"--seed-prefix {seed_prefix}")
+    if output:
+        args.append(f"--output {Path(output).resolve()}")
+    with Paths.cd(c, Paths.src):
+        c.run("python -m utils.draw_sim " + " ".join(args))